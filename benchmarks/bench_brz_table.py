@@ -0,0 +1,109 @@
+"""
+Copyright (C) 2026 Stanislav Bobovych
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Compare the bulk directory table parser against the old per entry f.read() parser.
+"""
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from brz_magick import read_table, BrzFileEntry
+
+
+def make_table(path, entries):
+    """ Write a brz file that only has a directory table with tiny payloads."""
+    records = []
+    for i in range(0, entries):
+        name = ("file%06i.bmp" % i).encode("ascii")
+        dir_name = ("data\\textures\\set%03i" % (i % 500)).encode("ascii")
+        records.append((name, dir_name))
+    offset = 8 + sum(8 + len(n) + len(d) for n, d in records)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<II", 0, entries))
+        for name, dir_name in records:
+            f.write(struct.pack("<IH%isH%is" % (len(name), len(dir_name)), offset, len(name), name, len(dir_name), dir_name))
+            offset += 4
+        f.write(b"\0" * 4 * entries)
+
+
+def read_table_legacy(f):
+    """ The parser BrzFile.unpack used before read_table."""
+    entries = []
+    u1, file_count = struct.unpack("<II", f.read(8))
+    for i in range(0, file_count):
+        offset, = struct.unpack("<I", f.read(4))
+        name_len, = struct.unpack("<H", f.read(2))
+        file_name, = struct.unpack("%is" % name_len, f.read(name_len))
+        dir_len, = struct.unpack("<H", f.read(2))
+        dir_name, = struct.unpack("%is" % dir_len, f.read(dir_len))
+        entries.append(BrzFileEntry(file_name, dir_name, offset))
+    return entries
+
+
+def retained_memory(func):
+    """ Bytes still allocated when func returns, i.e. the size of its result, and the result."""
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def best_of(repeat, func):
+    best = None
+    for i in range(0, repeat):
+        t0 = time.perf_counter()
+        func()
+        t1 = time.perf_counter()
+        if best is None or t1 - t0 < best:
+            best = t1 - t0
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark brz directory table parsing.')
+    parser.add_argument('-n', '--entries', type=int, default=50000, help='Number of entries in the synthetic table')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of timed runs, the best is reported')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".brz")
+    os.close(fd)
+    try:
+        make_table(path, args.entries)
+        size = os.path.getsize(path)
+
+        def legacy():
+            with open(path, "rb") as f:
+                return read_table_legacy(f)
+
+        def bulk():
+            with open(path, "rb") as f:
+                return read_table(f, size)
+
+        t_legacy = best_of(args.repeat, legacy)
+        t_bulk = best_of(args.repeat, bulk)
+        m_legacy, result = retained_memory(legacy)
+        del result
+        m_bulk, result = retained_memory(bulk)
+        del result
+        print("Entries:  %i" % args.entries)
+        print("Legacy:   %.4f s, %.1f bytes/entry retained" % (t_legacy, m_legacy / args.entries))
+        print("Bulk:     %.4f s, %.1f bytes/entry retained" % (t_bulk, m_bulk / args.entries))
+        print("Speedup:  %.2fx" % (t_legacy / t_bulk))
+    finally:
+        os.remove(path)
@@ -0,0 +1,177 @@
+"""
+Copyright (C) 2026 Stanislav Bobovych
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Time mdr parse, write and OBJ export and brz list, extract and pack on a synthetic corpus.
+Results are written as JSON, --compare prints the ratio against an earlier run.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from corpus import ROOT, make_corpus, make_archive
+sys.path.append(ROOT)
+from mdr import MDR
+from brz_magick import BrzFile
+from unmdr import make_wavefront_obj
+
+
+def best_of(repeat, func):
+    best = None
+    for i in range(0, repeat):
+        t0 = time.perf_counter()
+        func()
+        t1 = time.perf_counter()
+        if best is None or t1 - t0 < best:
+            best = t1 - t0
+    return best
+
+
+def peak_memory(func):
+    """ Peak traced allocation of one call in bytes, numpy buffers included."""
+    tracemalloc.start()
+    func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def measure(name, func, repeat, nbytes, items):
+    """ Run func quietly, return its timing, throughput and peak memory."""
+    def quiet():
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+    seconds = best_of(repeat, quiet)
+    result = {"seconds": seconds, "bytes": nbytes, "items": items,
+              "mb_per_s": nbytes / seconds / 1e6, "items_per_s": items / seconds,
+              "peak_bytes": peak_memory(quiet)}
+    print("%-10s %9.4f s %9.1f MB/s %11.1f items/s %9.1f MB peak" % (
+        name, seconds, result["mb_per_s"], result["items_per_s"], result["peak_bytes"] / 1e6))
+    return result
+
+
+def run(workdir, args):
+    corpus = os.path.join(workdir, "corpus")
+    archive = os.path.join(workdir, "corpus.brz")
+    paths = make_corpus(corpus, args.models, args.objects, args.vertices, args.anchors, args.entries,
+                        args.entry_size, args.seed)
+    make_archive(archive, corpus)
+    mdr_bytes = sum(os.path.getsize(p) for p in paths)
+    archive_bytes = os.path.getsize(archive)
+    file_count = args.models + args.entries
+    models = []
+    for path in paths:
+        m = MDR(path, os.path.splitext(os.path.basename(path))[0])
+        m.read(workdir)
+        models.append(m)
+    object_count = sum(len(m.objects) for m in models)
+    results = {}
+
+    def parse():
+        for path in paths:
+            MDR(path, "bench").read(workdir)
+    results["parse"] = measure("parse", parse, args.repeat, mdr_bytes, object_count)
+
+    out_mdr = os.path.join(workdir, "out.mdr")
+
+    def write():
+        for m in models:
+            m.write(out_mdr)
+    results["write"] = measure("write", write, args.repeat, mdr_bytes, object_count)
+
+    def export_obj():
+        for m in models:
+            for ob in m.objects:
+                make_wavefront_obj(ob)
+    results["obj"] = measure("obj", export_obj, args.repeat, mdr_bytes, object_count)
+
+    def list_entries():
+        BrzFile(archive).unpack(workdir, list_only=True)
+    results["list"] = measure("list", list_entries, args.repeat, archive_bytes, file_count)
+
+    extract_dir = os.path.join(workdir, "extract")
+
+    def extract():
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        BrzFile(archive).unpack(extract_dir)
+    results["extract"] = measure("extract", extract, args.repeat, archive_bytes, file_count)
+
+    def extract_parallel():
+        shutil.rmtree(extract_dir, ignore_errors=True)
+        BrzFile(archive).unpack(extract_dir, parallel=True, workers=args.jobs)
+    results["extract_parallel"] = measure("extract -p", extract_parallel, args.repeat, archive_bytes, file_count)
+
+    out_brz = os.path.join(workdir, "out.brz")
+
+    def pack():
+        BrzFile(out_brz).pack(os.path.join(corpus, "data"))
+    results["pack"] = measure("pack", pack, args.repeat, archive_bytes, file_count)
+    return results
+
+
+def compare(results, parameters, baseline):
+    """ Print how much faster each benchmark got relative to a saved run."""
+    print("\n%-18s %10s %10s %8s" % ("", "baseline", "current", "speedup"))
+    for name, result in sorted(results.items()):
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["seconds"]
+        print("%-18s %10.4f %10.4f %7.2fx" % (name, old, result["seconds"], old / result["seconds"]))
+    if baseline["parameters"] != parameters:
+        print("Note: the baseline was run with different parameters")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the mdr and brz tools on a synthetic corpus.')
+    parser.add_argument('-m', '--models', type=int, default=8, help='Number of mdr files')
+    parser.add_argument('--objects', type=int, default=4, help='Submodels per mdr file')
+    parser.add_argument('--vertices', type=int, default=2000, help='Vertices per submodel, faces are twice that')
+    parser.add_argument('--anchors', type=int, default=2, help='Anchor points per submodel')
+    parser.add_argument('-n', '--entries', type=int, default=2000, help='Extra filler entries in the archive')
+    parser.add_argument('--entry-size', type=int, default=4096, help='Size of a filler entry in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the corpus')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of timed runs, the best is reported')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Workers for the parallel extract (default all cores)')
+    parser.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run to compare against')
+    parser.add_argument('--workdir', default=None, help='Generate the corpus here and keep it (default a temporary directory)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cm2tools_bench_")
+    try:
+        results = run(workdir, args)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    parameters = {name: getattr(args, name) for name in ("models", "objects", "vertices", "anchors", "entries",
+                                                         "entry_size", "seed", "repeat", "jobs")}
+    report = {"parameters": parameters, "python": platform.python_version(), "numpy": np.__version__,
+              "platform": platform.platform(), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, parameters, json.load(f))
@@ -0,0 +1,132 @@
+"""
+Copyright (C) 2026 Stanislav Bobovych
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Generate a synthetic corpus of mdr models and a brz archive holding them.
+The same seed always gives the same bytes, so benchmark runs on different machines or commits compare.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "io_scene_mdr"))
+from mdr import MDR, MDRObject
+from brz_magick import BrzFile
+
+
+def random_transform(rnd):
+    """ 4x4 matrix rotating by a random angle about z and moving by a random offset."""
+    angle = rnd.uniform(0, 2 * np.pi)
+    transform = np.identity(4)
+    transform[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    transform[:3, 3] = rnd.randn(3)
+    return transform
+
+
+def make_model(path, objects=4, vertices=2000, anchors=2, seed=0):
+    """ Build an MDR with objects submodels of vertices vertices each. Submodels form a binary tree below
+    the first one and every submodel and anchor point has a random rotation about z and translation."""
+    rnd = np.random.RandomState(seed)
+    m = MDR(path, os.path.splitext(os.path.basename(path))[0])
+    for k in range(0, objects):
+        ob = MDRObject()
+        ob.name = "part%i" % k
+        ob.parent_name = "" if k == 0 else "part%i" % ((k - 1) // 2)
+        ob.index_array = rnd.randint(0, vertices, (vertices * 2, 3))
+        ob.uv_array = rnd.rand(vertices, 2)
+        ob.vertex_array = rnd.randn(vertices, 3)
+        ob.vertex_normal_array = rnd.randint(-32767, 32767, (vertices, 3))
+        transform = random_transform(rnd)
+        ob.transform_matrix = transform
+        ob.inverse_transform_matrix = np.linalg.inv(transform)
+        ob.anchor_points = [("anchor%i" % a, random_transform(rnd)) for a in range(0, anchors)]
+        ob.material = {"diffuse_color": (0.5, 0.5, 0.5), "specular_color": (0.1, 0.1, 0.1), "shininess": 10.0,
+                       "alpha_constant": 1.0, "material_id": k}
+        ob.texture_name = "texture%i" % k
+        ob.meta_data1 = rnd.rand(11)
+        ob.meta_data2 = rnd.rand(24)
+        ob.meta_data3 = rnd.rand(35)
+        ob.meta_data_unk1 = rnd.rand(3)
+        ob.meta_data_unk2 = rnd.rand(3)
+        m.objects.append(ob)
+    m.write(path)
+    check_round_trip(m, path)
+    return m
+
+
+def check_round_trip(m, path):
+    """ Read path back and raise ValueError if a matrix or geometry array differs from what m holds.
+    Objects with more vertices than 16 bit indices address are compared with the pieces MDR.write splits them into."""
+    back = MDR(path, m.base_name)
+    back.read(os.path.dirname(path))
+    written = [piece for ob in m.objects for piece in ob.split()]
+    if len(back.objects) != len(written):
+        raise ValueError("%s: wrote %i objects, read %i" % (path, len(written), len(back.objects)))
+    for ob, read_ob in zip(written, back.objects):
+        pairs = [(name, getattr(ob, name), getattr(read_ob, name)) for name in
+                 ("transform_matrix", "inverse_transform_matrix", "index_array", "uv_array", "vertex_array",
+                  "vertex_normal_array")]
+        pairs += [("anchor " + name, matrix, read_matrix) for (name, matrix), (read_name, read_matrix) in
+                  zip(ob.anchor_points, read_ob.anchor_points)]
+        for name, value, read_value in pairs:
+            value = np.asarray(value, dtype=np.float64)
+            if value.shape != read_value.shape or not np.allclose(value, read_value, rtol=1e-6, atol=1e-6):
+                raise ValueError("%s: %s of %s does not survive a write and read" % (path, name, ob.name))
+
+
+def make_corpus(directory, models=8, objects=4, vertices=2000, anchors=2, entries=0, entry_size=4096, seed=0):
+    """ Write models mdr files under directory/data/models and entries filler files under
+    directory/data/textures. Returns the list of mdr paths."""
+    rnd = np.random.RandomState(seed)
+    model_dir = os.path.join(directory, "data", "models")
+    os.makedirs(model_dir, exist_ok=True)
+    paths = []
+    for i in range(0, models):
+        path = os.path.join(model_dir, "model%04i.mdr" % i)
+        make_model(path, objects, vertices, anchors, seed + i)
+        paths.append(path)
+    for i in range(0, entries):
+        texture_dir = os.path.join(directory, "data", "textures", "set%03i" % (i % 100))
+        os.makedirs(texture_dir, exist_ok=True)
+        with open(os.path.join(texture_dir, "texture%06i.bmp" % i), "wb") as f:
+            f.write(rnd.randint(0, 256, entry_size, dtype=np.uint8).tobytes())
+    return paths
+
+
+def make_archive(path, directory):
+    """ Pack directory/data into the brz file path with BrzFile.pack."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        BrzFile(path).pack(os.path.join(directory, "data"))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic mdr/brz corpus.')
+    parser.add_argument('outdir', help='Output directory')
+    parser.add_argument('-m', '--models', type=int, default=8, help='Number of mdr files')
+    parser.add_argument('--objects', type=int, default=4, help='Submodels per mdr file')
+    parser.add_argument('--vertices', type=int, default=2000, help='Vertices per submodel, faces are twice that')
+    parser.add_argument('--anchors', type=int, default=2, help='Anchor points per submodel')
+    parser.add_argument('-n', '--entries', type=int, default=0, help='Extra filler entries in the archive')
+    parser.add_argument('--entry-size', type=int, default=4096, help='Size of a filler entry in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    make_corpus(args.outdir, args.models, args.objects, args.vertices, args.anchors, args.entries, args.entry_size,
+                args.seed)
+    make_archive(os.path.join(args.outdir, "corpus.brz"), args.outdir)
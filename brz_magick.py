@@ -17,13 +17,16 @@ import os
 import errno
 import sys
 import time
-import ctypes
-from multiprocessing import Pool, Manager
-from itertools import repeat
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import BytesIO
+import mmap
+import hashlib
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from multiprocessing import Pool, cpu_count
+from toolstats import NO_STATS, Stats, add_arguments as add_stats_arguments
+
+COPY_BUFSIZE = 1024 * 1024
 
 
 def update_progress(progress):
@@ -31,97 +34,745 @@ def update_progress(progress):
     sys.stdout.flush()
 
 
+def make_dirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        # Reraise the error unless it's about an already existing directory
+        if err.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+
+# state of an extraction worker process, the archive is mapped once per worker and shared read-only
+_worker_mmap = None
+
+
+def _init_extract_worker(path):
+    global _worker_mmap
+    with open(path, "rb") as f:
+        _worker_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _extract_batch(batch):
+    """ Write out a batch of (offset, size, path) jobs covering a contiguous range of the archive."""
+    view = memoryview(_worker_mmap)
+    written = 0
+    for offset, size, new_file in batch:
+        with open(new_file, "wb") as f_new:
+            f_new.write(view[offset:offset+size])
+        written += size
+    view.release()
+    return len(batch), written
+
+
+def make_batches(jobs, batch_count):
+    """ Split offset ordered jobs into about batch_count runs of contiguous entries with similar byte sizes."""
+    total = sum(job[1] for job in jobs)
+    target = max(total // max(batch_count, 1), 1)
+    batches = []
+    batch = []
+    batch_size = 0
+    for job in jobs:
+        batch.append(job)
+        batch_size += job[1]
+        if batch_size >= target:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if len(batch) != 0:
+        batches.append(batch)
+    return batches
+
+
+def extract_parallel(path, jobs, workers=None, progress=None):
+    """ Extract (offset, size, path) jobs with a pool of workers that each map the archive once.
+    Workers get contiguous offset ranges so every worker reads sequentially.
+    progress is called with the fraction of files done each time a batch finishes."""
+    if workers is None:
+        workers = cpu_count()
+    jobs = sorted(jobs)
+    batches = make_batches(jobs, workers * 8)
+    done = 0
+    pool = Pool(workers, initializer=_init_extract_worker, initargs=(path,))
+    try:
+        for count, written in pool.imap_unordered(_extract_batch, batches):
+            done += count
+            if progress is not None:
+                progress(done / len(jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def make_table(entries):
+    """ Lay out the entries back to back after the directory table, set their offsets and return the table bytes."""
+    records = []
+    offset = 8
+    for entry in entries:
+        name = entry.name.encode("ascii")
+        dir_name = entry.dir.encode("ascii")
+        records.append((name, dir_name))
+        offset += 8 + len(name) + len(dir_name)
+    parts = [struct.pack("<II", 0, len(entries))]
+    for entry, (name, dir_name) in zip(entries, records):
+        entry.offset = offset
+        parts.append(struct.pack("<IH%isH%is" % (len(name), len(dir_name)), offset, len(name), name, len(dir_name), dir_name))
+        offset += entry.file_size
+    return b"".join(parts)
+
+
+def copy_range(fin, fout, size, offset=None):
+    """ Copy size bytes from fin (at offset, or its current position) to the current position of fout.
+    Uses os.copy_file_range or os.sendfile so the data never passes through Python, and falls back to
+    a bounded buffer copy. Both files should be unbuffered, or flushed, since their descriptors are used directly."""
+    fd_in = fin.fileno()
+    fd_out = fout.fileno()
+    if offset is None:
+        offset = os.lseek(fd_in, 0, os.SEEK_CUR)
+    end = offset + size
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(fd_in, fd_out, end - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # not supported between these files, e.g. different file systems on older kernels
+            pass
+    if offset < end and hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                copied = os.sendfile(fd_out, fd_in, offset, end - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass
+    if offset < end:
+        os.lseek(fd_in, offset, os.SEEK_SET)
+        while offset < end:
+            chunk = os.read(fd_in, min(COPY_BUFSIZE, end - offset))
+            if len(chunk) == 0:
+                break
+            view = memoryview(chunk)
+            while len(view) != 0:
+                view = view[os.write(fd_out, view):]
+            offset += len(chunk)
+    if offset != end:
+        raise IOError("Unexpected end of file while copying %s" % fin.name)
+    os.lseek(fd_in, end, os.SEEK_SET)
+
+
+def entry_key(dir_name, file_name):
+    """ Normalize a directory and file name into the key used by the lookup index.
+    BRZ archives store Windows style paths and the game looks files up case insensitively."""
+    path = "%s/%s" % (dir_name, file_name)
+    return path.replace('\\', '/').strip('/').lower()
+
+
+_ENTRY_HEAD = struct.Struct("<IH")
+_NAME_LEN = struct.Struct("<H")
+
+
+def read_table(f, archive_size):
+    """ Read the directory table of an open brz file with a single bulk read.
+    The table ends where the payload of the first entry starts, so its first offset tells how much to read."""
+    head = f.read(14)
+    u1, file_count = struct.unpack_from("<II", head, 0)
+    if file_count == 0:
+        return BrzTable()
+    first_offset, = struct.unpack_from("<I", head, 8)
+    header = head + f.read(max(first_offset, 64) - len(head))
+    while True:
+        try:
+            return BrzTable.parse(header, file_count, archive_size)
+        except struct.error:
+            # the first entry does not start right after the table, keep reading
+            more = f.read(len(header))
+            if len(more) == 0:
+                raise
+            header += more
+
+
+INDEX_MAGIC = b"BRZI"
+INDEX_VERSION = 1
+_INDEX_HEAD = struct.Struct("<4sIQQII")
+
+
+def default_index_cache():
+    """ Per user directory where cached brz directory tables are kept."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cm2tools", "brz_index")
+
+
+def index_cache_path(cache_dir, path):
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest + ".idx")
+
+
+def save_index(cache_file, path, stat, table):
+    """ Store a parsed directory table as: header, offsets, sizes and a NUL separated name blob."""
+    abs_path = os.path.abspath(path).encode("utf-8")
+    strings = "\0".join(table.names + table.dirs).encode("latin-1")
+    parts = [_INDEX_HEAD.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(table), table.header_size),
+             struct.pack("<H", len(abs_path)), abs_path,
+             table.offsets.tobytes(), table.sizes.tobytes(), strings]
+    make_dirs(os.path.dirname(cache_file))
+    tmp_file = "%s.%i.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "wb") as f:
+        f.write(b"".join(parts))
+    os.replace(tmp_file, cache_file)
+
+
+def load_index(cache_file, path, stat):
+    """ Return the cached BrzTable for path with a single read, or None if it is missing or stale."""
+    try:
+        with open(cache_file, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if len(data) < _INDEX_HEAD.size + 2:
+        return None
+    magic, version, size, mtime_ns, file_count, header_size = _INDEX_HEAD.unpack_from(data, 0)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+        return None
+    pos = _INDEX_HEAD.size
+    path_len, = struct.unpack_from("<H", data, pos)
+    pos += 2
+    if data[pos:pos+path_len] != os.path.abspath(path).encode("utf-8"):
+        return None
+    pos += path_len
+    table = BrzTable()
+    array_len = file_count * table.offsets.itemsize
+    table.offsets.frombytes(data[pos:pos+array_len])
+    pos += array_len
+    table.sizes.frombytes(data[pos:pos+array_len])
+    pos += array_len
+    if file_count != 0:
+        intern = sys.intern
+        strings = [intern(name) for name in data[pos:].decode("latin-1").split("\0")]
+        table.names = strings[:file_count]
+        table.dirs = strings[file_count:]
+    table.header_size = header_size
+    return table
+
+
+def load_table(f, index_cache=None):
+    """ Return the directory table of an open brz file, going through the index cache directory if one is given."""
+    stat = os.fstat(f.fileno())
+    if index_cache is None:
+        return read_table(f, stat.st_size)
+    cache_file = index_cache_path(index_cache, f.name)
+    table = load_index(cache_file, f.name, stat)
+    if table is None:
+        table = read_table(f, stat.st_size)
+        try:
+            save_index(cache_file, f.name, stat, table)
+        except (IOError, OSError) as err:
+            print("Could not write index cache %s: %s" % (cache_file, err))
+    return table
+
+
+def glob_to_regex(pattern):
+    """ Translate a glob into a regex over normalized "dir/name" keys.
+    * and ? do not cross directories, **/ matches any number of directories and
+    a pattern without a / is matched against the file name only."""
+    pattern = pattern.replace('\\', '/').strip('/').lower()
+    if '/' not in pattern:
+        pattern = "**/" + pattern
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == '*':
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == '?':
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+
+class EntryFilter:
+    """ Select brz entries by include and exclude globs, regexes and an explicit list of names."""
+    def __init__(self, include=(), exclude=(), regex=(), names=None):
+        self.include = [glob_to_regex(p) for p in include]
+        self.exclude = [glob_to_regex(p) for p in exclude]
+        self.regex = [re.compile(r, re.IGNORECASE) for r in regex]
+        self.names = None
+        if names is not None:
+            self.names = set(n.replace('\\', '/').strip('/').lower() for n in names)
+
+    @classmethod
+    def from_file_list(cls, path, **kwargs):
+        """ Read one "dir/name" per line, empty lines and lines starting with # are skipped."""
+        with open(path, "r") as f:
+            names = [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
+        return cls(names=names, **kwargs)
+
+    def match(self, key):
+        selected = len(self.include) == 0 and len(self.regex) == 0 and self.names is None
+        if not selected and self.names is not None:
+            selected = key in self.names
+        if not selected:
+            selected = any(p.match(key) for p in self.include) or any(r.search(key) for r in self.regex)
+        if selected and len(self.exclude) != 0:
+            selected = not any(p.match(key) for p in self.exclude)
+        return selected
+
+    def select(self, table):
+        """ Return the indices of the matching entries in ascending offset order."""
+        indices = [i for i in range(0, len(table)) if self.match(table.key(i))]
+        indices.sort(key=table.offsets.__getitem__)
+        return indices
+
+
+class BrzTable(object):
+    """ Directory table of a brz file kept as parallel arrays of offsets and sizes and interned names,
+    instead of one BrzFileEntry object per file."""
+    def __init__(self):
+        self.offsets = array('Q')
+        self.sizes = array('Q')
+        self.dirs = []
+        self.names = []
+        self.header_size = 8
+
+    @classmethod
+    def parse(cls, buf, file_count, archive_size):
+        """ Walk the table in buf, which starts at the beginning of the brz file."""
+        table = cls()
+        unpack_entry = _ENTRY_HEAD.unpack_from
+        unpack_len = _NAME_LEN.unpack_from
+        add_offset = table.offsets.append
+        add_name = table.names.append
+        add_dir = table.dirs.append
+        intern = sys.intern
+        # names are plain ascii, decode the whole table once and slice the text alongside the bytes
+        text = bytes(buf).decode("latin-1")
+        pos = 8
+        for i in range(0, file_count):
+            offset, name_len = unpack_entry(buf, pos)
+            pos += 6
+            add_name(intern(text[pos:pos+name_len]))
+            pos += name_len
+            dir_len, = unpack_len(buf, pos)
+            pos += 2
+            add_dir(intern(text[pos:pos+dir_len]))
+            pos += dir_len
+            add_offset(offset)
+        if pos > len(buf):
+            raise struct.error("directory table is truncated")
+        offsets = table.offsets
+        # file sizes are not stored, every file runs until the next one starts
+        sizes = table.sizes
+        for i in range(0, file_count - 1):
+            sizes.append(offsets[i+1] - offsets[i])
+        sizes.append(archive_size - offsets[-1])
+        table.header_size = pos
+        return table
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return BrzFileEntry(self.names[i], self.dirs[i], self.offsets[i], self.sizes[i])
+
+    def __iter__(self):
+        for i in range(0, len(self.offsets)):
+            yield self[i]
+
+    def key(self, i):
+        return entry_key(self.dirs[i], self.names[i])
+
+
 class BrzFile:
-    def __init__(self, path):
+    def __init__(self, path, index_cache=None, stats=NO_STATS):
         self.path = path
+        self.index_cache = index_cache
+        self.stats = stats
         self.file_count = 0
         self.brz_file_list = []
-        self.parallel = False
-        
-    def unpack(self, outdir, parallel=False, verbose=False, list_only=False):
-        self.parallel = parallel
+        self.table = BrzTable()
+        self.index = None
+        self._file = None
+        self._mmap = None
+        self._view = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """ Memory map the archive and parse the directory table once.
+        Entries can then be looked up by "dir/name" without reading the payload."""
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        with self.stats.stage("header") as stage:
+            self.table = load_table(self._file, self.index_cache)
+            stage.add(bytes_read=self.table.header_size)
+        self.file_count = len(self.table)
+        self.index = None
+        return self
+
+    def close(self):
+        """ Close the archive. Entry views that are still alive keep the map open, it is then
+        unmapped when the last of them is gone instead of invalidating them."""
+        view, mm, f = self._view, self._mmap, self._file
+        self._view = self._mmap = self._file = None
+        try:
+            if view is not None:
+                try:
+                    view.release()
+                except BufferError:
+                    pass
+            if mm is not None:
+                try:
+                    mm.close()
+                except BufferError:
+                    pass
+        finally:
+            if f is not None:
+                f.close()
+
+    def lookup(self, path):
+        """ Return the BrzFileEntry stored under path or None."""
+        if self._mmap is None:
+            self.open()
+        if self.index is None:
+            self.index = {self.table.key(i): i for i in range(0, self.file_count)}
+        i = self.index.get(path.replace('\\', '/').strip('/').lower())
+        if i is None:
+            return None
+        return self.table[i]
+
+    def read_entry(self, path):
+        """ Return a zero-copy memoryview of the entry stored under path.
+        The view stays valid after the archive is closed, release it to unmap the file early."""
+        entry = self.lookup(path)
+        if entry is None:
+            raise KeyError(path)
+        return self._view[entry.offset:entry.offset+entry.file_size]
+
+    def unpack(self, outdir, parallel=False, verbose=False, list_only=False, workers=None, entry_filter=None):
+        """ Extract all entries, or the ones entry_filter selects, in ascending offset order
+        so the archive is read front to back and skipped entries are never touched."""
         with open(self.path, "rb") as f:
-            u1, self.file_count = struct.unpack("<II", f.read(8))
-            # print("Unknown int: ", u1)
+            with self.stats.stage("header") as stage:
+                self.table = load_table(f, self.index_cache)
+                stage.add(bytes_read=self.table.header_size)
+            self.file_count = len(self.table)
             print("File count: %i" % self.file_count)
-            for i in range(0, self.file_count):
-                offset, = struct.unpack("<I", f.read(4))
-                name_len, = struct.unpack("<H", f.read(2))
-                file_name, = struct.unpack("%is" % name_len, f.read(name_len))        
-                dir_len, = struct.unpack("<H", f.read(2))
-                dir_name, = struct.unpack("%is" % dir_len, f.read(dir_len))
-                entry = BrzFileEntry(file_name, dir_name, offset)
-                if verbose:
-                    print(entry)
-                self.brz_file_list.append(entry)
-            if not self.parallel and not list_only:
-                for i in range(0, self.file_count):
-                    self.unpack_file(i, outdir, verbose)
-                    update_progress(i/self.file_count)
-            elif not list_only:
-                p = Pool()
-                m = Manager()
-                self.done_counter = m.Value(ctypes.c_ulong, 0)                
-                args = zip(list(range(0, self.file_count)), repeat(outdir, self.file_count), repeat(verbose, self.file_count))
-                result = p.starmap_async(self.unpack_file, args)
-                # monitor loop
-                while True:
-                    if result.ready():
-                        break
-                    else:
-                        size = self.done_counter.value
-                        progress = size / self.file_count
-                        update_progress(progress)
-                
-    def unpack_file(self, i, outdir, verbose=False):
-        with open(self.path, "rb") as f:
-            directory = os.path.join(outdir, self.brz_file_list[i].dir.decode("ascii"))
-            directory = directory.replace('\\', '/')
-            try: 
-                os.makedirs(directory)
-            except OSError as err:
-                # Reraise the error unless it's about an already existing directory 
-                if err.errno != errno.EEXIST or not os.path.isdir(directory): 
-                    raise
-            new_file = os.path.join(outdir, self.brz_file_list[i].dir.decode("ascii"), self.brz_file_list[i].name.decode("ascii"))
-            new_file = new_file.replace('\\', '/')
-            with open(new_file, "wb") as f_new:
-                f.seek(self.brz_file_list[i].offset)
-                if i != self.file_count-1:
-                    file_length = self.brz_file_list[i+1].offset - self.brz_file_list[i].offset
-                    f_new.write(f.read(file_length))
+            if entry_filter is None:
+                indices = sorted(range(0, self.file_count), key=self.table.offsets.__getitem__)
+            else:
+                indices = entry_filter.select(self.table)
+                print("Selected: %i" % len(indices))
+            if verbose:
+                for i in indices:
+                    print(self.table[i])
+            if list_only or len(indices) == 0:
+                return
+            jobs = self.extract_jobs(outdir, indices)
+            with self.stats.stage("extract") as stage:
+                if not parallel:
+                    for i, (offset, size, new_file) in enumerate(jobs):
+                        with open(new_file, "wb") as f_new:
+                            f.seek(offset)
+                            f_new.write(f.read(size))
+                        update_progress((i+1)/len(jobs))
                 else:
-                    f_new.write(f.read())
-        if self.parallel:
-            self.done_counter.value +=1
-        
+                    extract_parallel(self.path, jobs, workers, update_progress)
+                total = sum(size for offset, size, new_file in jobs)
+                stage.add(bytes_read=total, bytes_written=total)
+
+    def extract_jobs(self, outdir, indices=None):
+        """ Create the output directories and return (offset, size, path) for every entry to extract."""
+        if indices is None:
+            indices = range(0, len(self.table))
+        jobs = []
+        directories = set()
+        for i in indices:
+            directory = os.path.join(outdir, self.table.dirs[i]).replace('\\', '/')
+            if directory not in directories:
+                make_dirs(directory)
+                directories.add(directory)
+            new_file = os.path.join(directory, self.table.names[i])
+            jobs.append((self.table.offsets[i], self.table.sizes[i], new_file))
+        return jobs
+
+    def update(self, files, removed=(), outfile=None, verbose=False):
+        """ Replace, add and remove files in an existing brz file.
+        files maps "dir/name" to the path of the new content and removed lists "dir/name" to drop.
+        Sizes are implied by the next entry's offset and the table sits in front of the payload,
+        so the archive is rebuilt, but every run of unchanged entries is a single kernel side range
+        copy (a reflink on copy-on-write file systems) and only changed files are read."""
+        if outfile is None:
+            outfile = self.path
+        changed = {}
+        for path, source in files.items():
+            changed[path.replace('\\', '/').strip('/').lower()] = (path, source)
+        removed = set(path.replace('\\', '/').strip('/').lower() for path in removed)
+        with open(self.path, "rb", buffering=0) as f:
+            with self.stats.stage("header") as stage:
+                table = load_table(f, self.index_cache)
+                stage.add(bytes_read=table.header_size)
+            sep = '\\' if any('\\' in d for d in table.dirs) else os.sep
+            entries = []  # (entry, offset in the old archive or path of the new content)
+            new_entries = []  # ("Replaced" or "Added", entry), printed once make_table has set the offsets
+            for i in sorted(range(0, len(table)), key=table.offsets.__getitem__):
+                key = table.key(i)
+                if key in removed:
+                    if verbose:
+                        print("Removed", table[i])
+                    continue
+                entry = table[i]
+                if key in changed:
+                    path, source = changed.pop(key)
+                    entry.file_size = os.path.getsize(source)
+                    entries.append((entry, source))
+                    new_entries.append(("Replaced", entry))
+                else:
+                    entries.append((entry, table.offsets[i]))
+            for key in sorted(changed):
+                path, source = changed[key]
+                dir_name, name = os.path.split(path.replace('\\', '/').strip('/'))
+                entry = BrzFileEntry(name, dir_name.replace('/', sep), 0, os.path.getsize(source))
+                entries.append((entry, source))
+                new_entries.append(("Added", entry))
+
+            header = make_table([entry for entry, source in entries])
+            if verbose:
+                for action, entry in new_entries:
+                    print(action, entry)
+            tmp_file = "%s.%i.tmp" % (outfile, os.getpid())
+            try:
+                with self.stats.stage("write") as stage, open(tmp_file, "wb", buffering=0) as out:
+                    out.write(header)
+                    run_offset = 0
+                    run_size = 0
+                    for entry, source in entries:
+                        if not isinstance(source, str):
+                            if run_size != 0 and run_offset + run_size == source:
+                                run_size += entry.file_size
+                                continue
+                            if run_size != 0:
+                                copy_range(f, out, run_size, run_offset)
+                            run_offset = source
+                            run_size = entry.file_size
+                        else:
+                            if run_size != 0:
+                                copy_range(f, out, run_size, run_offset)
+                                run_size = 0
+                            with open(source, "rb", buffering=0) as ef:
+                                copy_range(ef, out, entry.file_size)
+                    if run_size != 0:
+                        copy_range(f, out, run_size, run_offset)
+                    total = len(header) + sum(entry.file_size for entry, source in entries)
+                    stage.add(bytes_read=total - len(header), bytes_written=total)
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+        os.replace(tmp_file, outfile)
+        self.table = BrzTable()
+        self.index = None
+        return len(entries)
+
     def pack(self, directory, verbose=False):
+        """ Stream the files under directory into a new brz file.
+        The table is computed from the file sizes up front, so only one file is open at a time
+        and its bytes are copied by the kernel where possible."""
         # walk through dirs and get file paths, file sizes and add lengths of file paths
-        if sys.version_info <= (3,0):
-            buf = StringIO()
-        else:
-            buf = BytesIO()
-        with open(self.path, "wb") as f:
-            f.write(struct.pack("II", 0,0))
+        with self.stats.stage("scan"):
             for dirpath, dirnames, filenames in os.walk(directory):
                 for filename in filenames:
                     rel_dir_path = os.path.relpath(dirpath, os.path.dirname(directory))
                     entry = BrzFileEntry(filename, rel_dir_path, 0, os.path.getsize(os.path.join(dirpath, filename)))
                     print(entry)
                     self.brz_file_list.append(entry)
-            f.seek(4)
-            f.write(struct.pack("<I", len(self.brz_file_list)))
-            offset = f.tell()
+            header = make_table(self.brz_file_list)
+        with self.stats.stage("write") as stage, open(self.path, "wb", buffering=0) as f:
+            f.write(header)
             for entry in self.brz_file_list:
-                offset += len(struct.pack("<IH%isH%is" % (len(entry.name), len(entry.dir)), entry.offset, len(entry.name), entry.name.encode("ascii"), len(entry.dir), entry.dir.encode("ascii")))
-                with open(os.path.join(os.path.dirname(directory), entry.dir, entry.name), "rb") as ef:
-                    buf.write(ef.read())
-            for entry in self.brz_file_list:                
-                f.write(struct.pack("<IH%isH%is" % (len(entry.name), len(entry.dir)), offset, len(entry.name), entry.name.encode("ascii"), len(entry.dir), entry.dir.encode("ascii")))
-                offset += entry.file_size
-            f.write(buf.getvalue())
-            
-            
+                with open(os.path.join(os.path.dirname(directory), entry.dir, entry.name), "rb", buffering=0) as ef:
+                    copy_range(ef, f, entry.file_size)
+                stage.add(bytes_read=entry.file_size, bytes_written=entry.file_size)
+            stage.add(bytes_written=len(header))
+
+
+def update_files(directory):
+    """ Map "dir/name" to the path of every file under directory, for BrzFile.update."""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files[os.path.relpath(path, directory).replace(os.sep, '/')] = path
+    return files
+
+
+def find_archives(root):
+    """ Return the brz files under root in the order the game loads them."""
+    if os.path.isfile(root):
+        return [root]
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(".brz"):
+                paths.append(os.path.join(dirpath, filename))
+    paths.sort(key=lambda p: os.path.relpath(p, root).replace('\\', '/').lower())
+    return paths
+
+
+def _hash_batch(view, batch, algorithm):
+    """ Hash (index, offset, size) entries of one contiguous range, hashlib releases the GIL on large buffers."""
+    digests = []
+    for i, offset, size in batch:
+        h = hashlib.new(algorithm)
+        h.update(view[offset:offset+size])
+        digests.append((i, h.hexdigest()))
+    return digests
+
+
+def hash_archive(path, algorithm="sha256", workers=None, index_cache=None):
+    """ Hash every entry of a brz file with a pool of threads over one read-only mapping.
+    Each thread gets a contiguous offset range, so the archive is read once, front to back.
+    Returns the table and a list with the digest of every entry."""
+    with open(path, "rb") as f:
+        table = load_table(f, index_cache)
+        digests = [None] * len(table)
+        if len(table) == 0:
+            return table, digests
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mm)
+    try:
+        if workers is None:
+            workers = cpu_count()
+        jobs = sorted((table.offsets[i], table.sizes[i], i) for i in range(0, len(table)))
+        batches = make_batches(jobs, workers * 4)
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(_hash_batch, view, [(i, offset, size) for offset, size, i in batch], algorithm)
+                       for batch in batches]
+            for future in futures:
+                for i, digest in future.result():
+                    digests[i] = digest
+    finally:
+        view.release()
+        mm.close()
+    return table, digests
+
+
+def hash_manifest(paths, algorithm="sha256", workers=None, index_cache=None):
+    """ Build a content addressed manifest of all entries in the given brz files:
+    {"algorithm": ..., "archives": [...], "objects": {digest: {"size": n, "files": [[archive, "dir/name"], ...]}}}"""
+    objects = {}
+    for archive, path in enumerate(paths):
+        table, digests = hash_archive(path, algorithm, workers, index_cache)
+        for i, digest in enumerate(digests):
+            name = "%s/%s" % (table.dirs[i].replace('\\', '/'), table.names[i])
+            obj = objects.setdefault(digest, {"size": table.sizes[i], "files": []})
+            obj["files"].append([archive, name])
+    return {"algorithm": algorithm, "archives": paths, "objects": objects}
+
+
+def print_duplicates(manifest):
+    """ Print every piece of content stored more than once, the biggest waste first."""
+    archives = manifest["archives"]
+    duplicates = [(obj["size"] * (len(obj["files"]) - 1), digest, obj) for digest, obj in manifest["objects"].items()
+                  if len(obj["files"]) > 1]
+    duplicates.sort(key=lambda d: (-d[0], d[1]))
+    for wasted, digest, obj in duplicates:
+        print("%s, %i bytes, %i copies" % (digest, obj["size"], len(obj["files"])))
+        for archive, name in obj["files"]:
+            print("    %s: %s" % (archives[archive], name))
+    file_count = sum(len(obj["files"]) for obj in manifest["objects"].values())
+    print("Files: %i, unique: %i" % (file_count, len(manifest["objects"])))
+    print("Duplicate bytes: %i" % sum(d[0] for d in duplicates))
+
+
+class BrzOverlay:
+    """ Resolve file names across all brz files under a directory the way the game does.
+    Archives are loaded in alphabetical order of their path and a file in a later archive
+    overrides the same file in earlier ones, which is why mods are usually prefixed with z."""
+    def __init__(self, root, index_cache=None):
+        self.root = root
+        self.index_cache = index_cache
+        self.archives = []
+        self.index = {}
+        self.overridden = {}
+        self._open = {}
+
+    def __enter__(self):
+        self.scan()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def scan(self):
+        """ Index every archive under root into one name -> (archive, offset, size) map."""
+        paths = find_archives(self.root)
+        self.archives = paths
+        self.index = {}
+        self.overridden = {}
+        for archive, path in enumerate(paths):
+            with open(path, "rb") as f:
+                table = load_table(f, self.index_cache)
+            for i in range(0, len(table)):
+                key = table.key(i)
+                previous = self.index.get(key)
+                if previous is not None:
+                    self.overridden.setdefault(key, []).append(previous[0])
+                self.index[key] = (archive, table.offsets[i], table.sizes[i])
+        return self
+
+    def close(self):
+        for brz in self._open.values():
+            brz.close()
+        self._open = {}
+
+    def lookup(self, path):
+        """ Return (archive path, offset, size) of the version of path the game would load, or None."""
+        found = self.index.get(path.replace('\\', '/').strip('/').lower())
+        if found is None:
+            return None
+        archive, offset, size = found
+        return self.archives[archive], offset, size
+
+    def sources(self, path):
+        """ Return every archive that has path, from the lowest to the highest priority."""
+        key = path.replace('\\', '/').strip('/').lower()
+        if key not in self.index:
+            return []
+        archives = self.overridden.get(key, []) + [self.index[key][0]]
+        return [self.archives[a] for a in archives]
+
+    def read_entry(self, path):
+        """ Return a zero-copy memoryview of the winning version of path."""
+        found = self.index.get(path.replace('\\', '/').strip('/').lower())
+        if found is None:
+            raise KeyError(path)
+        archive, offset, size = found
+        brz = self._open.get(archive)
+        if brz is None:
+            brz = BrzFile(self.archives[archive], self.index_cache).open()
+            self._open[archive] = brz
+        return brz._view[offset:offset+size]
+
+
 class BrzFileEntry(object):
     def __init__(self, name, path, offset, size=0):
         self.name = name
@@ -139,25 +790,95 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--extract', default=False, action='store_true', help="Unpack brz file")
     parser.add_argument('-c', '--compress', default=False, action='store_true', help="Pack files into brz")
     parser.add_argument('-l', '--list', default=False, action='store_true', help="List files in brz")
+    parser.add_argument('-g', '--get', default=None, help='Extract a single file by its "dir/name" path in the brz')
+    parser.add_argument('-r', '--resolve', default=None, help='Show which brz under the filepath directory provides "dir/name"')
+    parser.add_argument('-u', '--update', default=None, help='Replace or add the files in this directory in an existing brz')
+    parser.add_argument('--remove', default=[], action='append', help='Remove "dir/name" from an existing brz, can be repeated')
+    parser.add_argument('-i', '--include', default=[], action='append', help='Only extract or list files matching this glob, e.g. *.mdr or **/textures/*')
+    parser.add_argument('-e', '--exclude', default=[], action='append', help='Skip files matching this glob')
+    parser.add_argument('--regex', default=[], action='append', help='Only extract or list "dir/name" paths matching this regular expression')
+    parser.add_argument('--file-list', default=None, help='Only extract or list the "dir/name" paths listed in this file')
+    parser.add_argument('--hash', default=False, action='store_true',
+                        help='Hash every file in the brz, or all brz files under a directory, and report duplicates')
+    parser.add_argument('--manifest', default=None, help='Write a content addressed JSON manifest of --hash to this file')
     parser.add_argument('-o', '--outdir', default=os.getcwd(), help='Output directory')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Print info as files are unpacked')
-    parser.add_argument('-p', '--parallel', default=False, action='store_true', help='Use multiple workers when extracting files (This feature is experimental and will fail if not used from Python script)')
+    parser.add_argument('-p', '--parallel', default=False, action='store_true', help='Use multiple workers when extracting files')
+    parser.add_argument('--index-cache', default=False, action='store_true',
+                        help='Cache parsed directory tables and reuse them while the brz is unchanged')
+    parser.add_argument('--index-cache-dir', default=None, metavar='DIR',
+                        help='Directory of the index cache, implies --index-cache (default %s)' % default_index_cache())
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of workers used by --parallel, defaults to the number of cores')
+    add_stats_arguments(parser)
 
     args = parser.parse_args()
+    stats = Stats.from_args(args).start()
 
     filepath = args.filepath
     outdir = args.outdir
+    index_cache = args.index_cache_dir
+    if index_cache is None and args.index_cache:
+        index_cache = default_index_cache()
     if args.list:
         args.verbose = True
-    if args.extract or args.list and not args.compress:
+    if args.resolve is not None:
+        with BrzOverlay(filepath, index_cache) as overlay:
+            sources = overlay.sources(args.resolve)
+            if len(sources) == 0:
+                print("%s not found in %i brz files" % (args.resolve, len(overlay.archives)))
+            else:
+                archive, offset, size = overlay.lookup(args.resolve)
+                print("%s, 0x%x, %i" % (archive, offset, size))
+                for archive in reversed(sources[:-1]):
+                    print("overrides %s" % archive)
+    elif args.update is not None or len(args.remove) != 0:
+        t0 = time.time()
+        files = {}
+        if args.update is not None:
+            files = update_files(args.update)
+        count = BrzFile(filepath, index_cache, stats).update(files, args.remove, verbose=args.verbose)
+        t1 = time.time()
+        print("File count: %i" % count)
+        print("Time: ", t1 - t0)
+    elif args.hash:
+        t0 = time.time()
+        archives = find_archives(filepath)
+        with stats.stage("hash") as stage:
+            manifest = hash_manifest(archives, workers=args.jobs, index_cache=index_cache)
+            stage.add(bytes_read=sum(os.path.getsize(path) for path in archives))
+        print_duplicates(manifest)
+        if args.manifest is not None:
+            with open(args.manifest, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        t1 = time.time()
+        print("Time: ", t1 - t0)
+    elif args.get is not None:
+        with BrzFile(filepath, index_cache, stats) as brz:
+            if brz.lookup(args.get) is None:
+                print("%s not found in %s" % (args.get, filepath))
+            else:
+                data = brz.read_entry(args.get)
+                new_file = os.path.join(outdir, os.path.basename(args.get.replace('\\', '/')))
+                with stats.stage("write") as stage, open(new_file, "wb") as f_new:
+                    f_new.write(data)
+                    stage.add(bytes_read=len(data), bytes_written=len(data))
+                data.release()
+                print("Wrote", new_file)
+    elif args.extract or args.list and not args.compress:
         t0 = time.time()
-        BrzFile(filepath).unpack(outdir, args.parallel, args.verbose, args.list)
+        entry_filter = None
+        if args.file_list is not None:
+            entry_filter = EntryFilter.from_file_list(args.file_list, include=args.include, exclude=args.exclude, regex=args.regex)
+        elif len(args.include) != 0 or len(args.exclude) != 0 or len(args.regex) != 0:
+            entry_filter = EntryFilter(args.include, args.exclude, args.regex)
+        BrzFile(filepath, index_cache, stats).unpack(outdir, args.parallel, args.verbose, args.list, args.jobs, entry_filter)
         t1 = time.time()
         print("Time: ", t1 - t0)
     elif args.compress and not args.extract:
         indir = os.path.split(filepath)[0]
         outfile = os.path.join(args.outdir, indir + ".brz")
-        BrzFile(outfile).pack(filepath)
+        BrzFile(outfile, stats=stats).pack(filepath)
     else:
         print("Unknown command")
         parser.print_help()
+    stats.finish()
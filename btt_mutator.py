@@ -18,6 +18,7 @@ import sys
 import struct
 import shutil
 from bidict import bidict
+from toolstats import Stats, add_arguments as add_stats_arguments
 
 CM_ID_CONST = bidict({'CMSF':0x00, 'CMA':0x02, 'CMBN':0x04, 'CMFI':0x06, 'CMRT':0x08, 'CMBS':0x0A, 'CMFB':0x0C})
 
@@ -26,8 +27,10 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--type', required=True, choices=['CMSF', 'CMA', 'CMBN', 'CMFI', 'CMRT', 'CMBS', 'CMFB'], help='Output map type')
     parser.add_argument('-o', '--outdir', default=os.getcwd(), help='Output path')
     parser.add_argument('file', nargs='?', help='Input file')
+    add_stats_arguments(parser)
 
     args = parser.parse_args()
+    stats = Stats.from_args(args).start()
     indir = os.path.split(args.file)[0]
     infile = os.path.split(args.file)[1]    
     basename,extension = os.path.splitext(infile)
@@ -35,9 +38,10 @@ if __name__ == "__main__":
     outfile = new_basename + extension
     outdir = args.outdir
 
-    with open(args.file, 'rb') as f:
+    with stats.stage("header") as stage, open(args.file, 'rb') as f:
         f.seek(0x10)
         map_type, = struct.unpack("H", f.read(2))
+        stage.add(bytes_read=2)
         try:
             print("Input map type:", CM_ID_CONST.inverse[map_type])
         except:
@@ -45,12 +49,17 @@ if __name__ == "__main__":
             sys.exit(1)
 
     outfile_full_path = os.path.join(outdir, outfile)
-    shutil.copy(args.file, outfile_full_path)
+    with stats.stage("copy") as stage:
+        shutil.copy(args.file, outfile_full_path)
+        size = os.path.getsize(outfile_full_path)
+        stage.add(bytes_read=size, bytes_written=size)
 
-    with open(outfile_full_path, 'r+b') as f:
+    with stats.stage("write") as stage, open(outfile_full_path, 'r+b') as f:
         f.seek(0x10)
         type_bytes = struct.pack("H", CM_ID_CONST[args.type])
         f.write(type_bytes)
+        stage.add(bytes_written=len(type_bytes))
         print("Generated output map:", outfile)
+    stats.finish()
 
     #TODO game version follows game id
@@ -155,6 +155,12 @@ class ExportMDR(bpy.types.Operator, ExportHelper, IOOBJOrientationHelper):
         description="Export metadata from object custom properties",
         default=False,
     )
+    use_optimize = BoolProperty(
+        name="Optimize for vertex cache",
+        description="Reorder faces and vertices so the GPU reuses transformed vertices, "
+                    "prints the ACMR (vertices per face) before and after",
+        default=False,
+    )
     path_mode = path_reference_mode
 
     check_extension = True
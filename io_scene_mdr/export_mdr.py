@@ -32,6 +32,7 @@ import os
 import math
 from mathutils import Matrix, Vector
 from .mdr import MDR, MDRObject
+from .mdr_optimize import optimize_model
 
 
 def bounds(obj, local=False):
@@ -62,7 +63,7 @@ def bounds(obj, local=False):
     return o_details(**originals)
 
 
-def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mode='AUTO'):
+def save(operator, context, filepath, var_float=1.0, use_metadata=False, use_optimize=False, path_mode='AUTO'):
     if len(bpy.context.selected_objects) == 0:
         operator.report({'ERROR'}, "You must select a mesh object to export")
         return {'CANCELLED'}
@@ -88,7 +89,6 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
             mdr_obj.name = ob.name.encode('ascii')
             if ob.parent is not None:
                 mdr_obj.parent_name = ob.parent.name.encode('ascii')
-            mdr_obj.index_array = None
 
             for c in ob.children:
                 print("Checking children", c, c.type)
@@ -96,8 +96,8 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
                     # print(c.name, c.matrix_world)
                     achor_matrix = c.matrix_world * Matrix.Rotation(math.radians(-90), 4, "Y")
                     # print(achor_matrix)
-                    print(c.name, Matrix.transposed(achor_matrix))
-                    mdr_obj.anchor_points.append((c.name.encode('ascii'), Matrix.transposed(achor_matrix)))
+                    print(c.name, achor_matrix)
+                    mdr_obj.anchor_points.append((c.name.encode('ascii'), achor_matrix))
 
             index_array = []
             me = ob.data
@@ -110,7 +110,6 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
             uv_data = me.uv_layers.active.data
 
             uv_array = [None] * len(me.vertices)
-            mdr_obj.uv_array = uv_array
             vertex_array = []
             vertex_normal_array = []
             for vert in me.vertices:
@@ -133,9 +132,9 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
                     vi = me.loops[li].vertex_index
                     uv = uv_data[li].uv
                     # print("    Loop index %i (Vertex %i) - UV %f %f" % (li, vi, uv.x, uv.y))
-                    mdr_obj.uv_array[vi] = uv
-            # for i in range(0, len(mdr_obj.uv_array)):
-            #     print(i, mdr_obj.uv_array[i])
+                    uv_array[vi] = uv
+            # for i in range(0, len(uv_array)):
+            #     print(i, uv_array[i])
 
             # bound box
             object_bound_box = bounds(ob, False)
@@ -165,8 +164,8 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
             mdr_obj.vertex_array = vertex_array
             mdr_obj.vertex_normal_array = vertex_normal_array
             mdr_obj.texture_name = diffuse_texture_file.encode('ascii')
-            mdr_obj.transform_matrix = matrix_world.transposed()  # Blender stores matrix in row-major, mdr uses column major
-            mdr_obj.inverse_transform_matrix = matrix_world.inverted().transposed()
+            mdr_obj.transform_matrix = matrix_world  # MDR.write stores it in column order
+            mdr_obj.inverse_transform_matrix = matrix_world.inverted()
             mdr_obj.material["diffuse_color"] = tuple(ob.material_slots[0].material.diffuse_color)
             mdr_obj.material["specular_color"] = tuple(ob.material_slots[0].material.specular_color)
             mdr_obj.material["shininess"] = (ob.material_slots[0].material.specular_hardness / 511.0) * 128.0  # GL_SHININESS is 0 to 128
@@ -175,28 +174,31 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
                 if ob.material_slots[0].material == bpy.data.materials[key]:
                     mdr_obj.material["material_id"] = i
 
-            mdr_obj.meta_data1 = []
-            mdr_obj.meta_data2 = []
-            mdr_obj.meta_data3 = []
+            meta_data1 = []
+            meta_data2 = []
+            meta_data3 = []
             mdr_obj.foliage_meta = {}
             if use_metadata:
                 for i in range(0, 11):
                     try:
-                        mdr_obj.meta_data1.append(ob["meta1_%i" % i])
+                        meta_data1.append(ob["meta1_%i" % i])
                     except KeyError as e:
                         print(e)
                 for i in range(0, 24):
                     try:
-                        mdr_obj.meta_data2.append(ob["meta2_%i" % i])
+                        meta_data2.append(ob["meta2_%i" % i])
                     except KeyError as e:
                         print(e)
                 for i in range(0, 35):
                     try:
-                        mdr_obj.meta_data3.append(ob["meta3_%i" % i])
+                        meta_data3.append(ob["meta3_%i" % i])
                     except KeyError as e:
                         print(e)
-                mdr_obj.meta_data_unk1 = ob["meta_unk1"]
-                mdr_obj.meta_data_unk2 = ob["meta_unk2"]
+                mdr_obj.meta_data_unk1 = list(ob["meta_unk1"])
+                mdr_obj.meta_data_unk2 = list(ob["meta_unk2"])
+            mdr_obj.meta_data1 = meta_data1
+            mdr_obj.meta_data2 = meta_data2
+            mdr_obj.meta_data3 = meta_data3
             #TODO export foliage_meta
             print("Exporting %i faces" % len(mdr_obj.index_array))
             print("Exporting %i texture coords" % len(mdr_obj.uv_array))
@@ -204,6 +206,17 @@ def save(operator, context, filepath, var_float=1.0, use_metadata=False, path_mo
             mdr_obj.var_float = var_float
             m.objects.append(mdr_obj)
 
+    if use_optimize:
+        # reorder faces and vertices for the GPU vertex cache, ACMR is vertices transformed per face
+        faces = total_before = total_after = 0
+        for ob, (name, before, after) in zip(m.objects, optimize_model(m)):
+            print("Optimized %s: ACMR %.3f -> %.3f" % (name, before, after))
+            faces += len(ob.index_array)
+            total_before += before * len(ob.index_array)
+            total_after += after * len(ob.index_array)
+        if faces:
+            operator.report({'INFO'}, "Vertex cache ACMR %.3f -> %.3f" % (total_before / faces, total_after / faces))
+
     m.write(filepath)
 
     return {'FINISHED'}
@@ -49,8 +49,9 @@ def load(context, use_shadeless, use_smooth_shading, use_transform, use_recursiv
 
     for mdr_ob in m.objects:
         print(mdr_ob.name)
-        verts_loc = mdr_ob.vertex_array
-        faces = mdr_ob.index_array
+        verts_loc = mdr_ob.vertex_array.tolist()
+        faces = mdr_ob.index_array.tolist()
+        uvs = mdr_ob.uv_array.tolist()
         me = bpy.data.meshes.new(mdr_ob.name)
 
         me.vertices.add(len(verts_loc))
@@ -85,7 +86,7 @@ def load(context, use_shadeless, use_smooth_shading, use_transform, use_recursiv
                 f.use_smooth = True
             for li in f.loop_indices:
                 vi = me.loops[li].vertex_index
-                blen_uvs.data[li].uv = mdr_ob.uv_array[vi]
+                blen_uvs.data[li].uv = uvs[vi]
 
         material_name = "%s_%i" % (mdr_ob.texture_name, mdr_ob.material["material_id"])
 
@@ -225,14 +226,14 @@ def load(context, use_shadeless, use_smooth_shading, use_transform, use_recursiv
 
         # metadata
         if use_metadata:
-            for i in range(0, len(mdr_ob.meta_data1)):
-                ob["meta1_%i" % i] = mdr_ob.meta_data1[i]
-            for i in range(0, len(mdr_ob.meta_data2)):
-                ob["meta2_%i" % i] = mdr_ob.meta_data2[i]
-            for i in range(0, len(mdr_ob.meta_data3)):
-                ob["meta3_%i" % i] = mdr_ob.meta_data3[i]
-            ob["meta_unk1"] = mdr_ob.meta_data_unk1
-            ob["meta_unk2"] = mdr_ob.meta_data_unk2
+            for i, value in enumerate(mdr_ob.meta_data1.tolist()):
+                ob["meta1_%i" % i] = value
+            for i, value in enumerate(mdr_ob.meta_data2.tolist()):
+                ob["meta2_%i" % i] = value
+            for i, value in enumerate(mdr_ob.meta_data3.tolist()):
+                ob["meta3_%i" % i] = value
+            ob["meta_unk1"] = mdr_ob.meta_data_unk1.tolist()
+            ob["meta_unk2"] = mdr_ob.meta_data_unk2.tolist()
             for meta in mdr_ob.foliage_meta:
                 ob["foliage_meta_%s" % meta] = mdr_ob.foliage_meta[meta]
         context.scene.objects.link(ob)
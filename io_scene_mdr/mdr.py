@@ -29,8 +29,10 @@ Run this script from "File->Import" menu and then load the desired MDR file.
 """
 
 import numpy as np
+import json
+import mmap
 import struct
-from pprint import pprint
+import sys
 
 
 def print4x4matrix(matrix):
@@ -40,154 +42,289 @@ def print4x4matrix(matrix):
     print("]")
 
 
-def read_matrix(f):
-    print("# Start reading matrix", "0x%x" % f.tell())
-    mat = np.identity(4)
+TRACE_QUIET = 0    # nothing at all
+TRACE_WARNING = 1  # anomalies in the file, the default
+TRACE_SECTION = 2  # one event per section with its offset and length
+TRACE_DETAIL = 3   # every value that is decoded, for reverse engineering
+
+
+class Trace:
+    """Structured trace of the parser. Events carry a name plus fields such as the byte offset and
+    length of a section and are written as "# " comment lines and/or JSON lines. Call sites check
+    the level before building anything expensive, so a quiet trace costs a single comparison.
+    If events is a list, every event is also appended to it as a dict."""
+    def __init__(self, level=TRACE_WARNING, out=sys.stdout, json_out=None, events=None):
+        self.level = level
+        self.out = out
+        self.json_out = json_out
+        self.events = events
+
+    def emit(self, level, event, **fields):
+        if level > self.level:
+            return
+        if self.out is not None:
+            text = " ".join("%s=%s" % (k, ("0x%x" % v) if k == "offset" else v) for k, v in fields.items())
+            self.out.write("# %s %s\n" % (event, text))
+        if self.json_out is not None or self.events is not None:
+            fields["event"] = event
+            if self.json_out is not None:
+                self.json_out.write(json.dumps(fields, default=_json_value) + "\n")
+            if self.events is not None:
+                self.events.append(fields)
+
+    def section(self, name, offset, length, **fields):
+        if self.level >= TRACE_SECTION:
+            self.emit(TRACE_SECTION, "section", name=name, offset=offset, length=length, **fields)
+
+    def warning(self, message, **fields):
+        if self.level >= TRACE_WARNING:
+            self.emit(TRACE_WARNING, "warning", message=message, **fields)
+
+
+def _json_value(value):
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
 
+# warnings to stdout like MDR uses when no trace is given
+DEFAULT_TRACE = Trace(TRACE_WARNING)
+
+
+def read_matrix(f, trace=DEFAULT_TRACE):
+    offset = f.tell()
+    mat = np.identity(4)
     # 3x4 matrix, column order
-    for column in range(0, 4):
-        for row in range(0, 3):
-            value, = struct.unpack("f", f.read(4))
-            print("# 0x%x [%i] %f" % (f.tell()-4, column, value))
-            mat[row][column] = value
-    print("# This is a transform matrix:")
-    print(mat)
+    mat[:3, :] = np.frombuffer(f.read(48), dtype="<f4").reshape(4, 3).T
+    if trace.level >= TRACE_DETAIL:
+        trace.emit(TRACE_DETAIL, "matrix", offset=offset, value=mat[:3, :].T.ravel().tolist())
     return mat
 
 
+def read_array(f, dtype, count, width):
+    """Read count rows of width little endian values straight into a new array."""
+    array = np.empty((count, width), dtype=dtype)
+    if f.readinto(array) != array.nbytes:
+        raise struct.error("unexpected end of file reading %i x %i %s" % (count, width, dtype))
+    return array
+
+
+def matrix_bytes(mat):
+    # 3x4 matrix, column order, the inverse of read_matrix
+    return np.ascontiguousarray(np.asarray(mat, dtype="<f4")[:3, :4].T).tobytes()
+
+
 def write_matrix(mat, f):
-    # 3x4 matrix, column order
-    for column in range(0, 4):
-        f.write(struct.pack("fff", *mat[column][:3]))
-
-
-def read_material(f):
-    print("# Start reading material", "0x%x" % f.tell())
-    ambient_color = struct.unpack("fff", f.read(4 * 3))
-    print("# Ambient color", ambient_color)  # GL_AMBIENT
-    diffuse_color = struct.unpack("fff", f.read(4 * 3))
-    print("# Diffuse color", diffuse_color)  # GL_DIFFUSE
-    specular_color = struct.unpack("fff", f.read(4 * 3))
-    print("# Specular color", specular_color)  # GL_SPECULAR
-    shininess, = struct.unpack("f", f.read(4))
-    print("# Shininess", shininess)  # GL_SHININESS
+    f.write(matrix_bytes(mat))
+
+
+def string_bytes(value):
+    """Length prefixed ascii string, value can be str or bytes."""
+    if not isinstance(value, bytes):
+        value = value.encode("ascii")
+    return struct.pack("<H", len(value)) + value
+
+
+def array_bytes(array, dtype, width):
+    """Element count followed by the raw little endian array data."""
+    array = np.asarray(array, dtype=dtype).reshape(-1, width)
+    return struct.pack("<I", array.size) + array.tobytes()
+
+
+def read_material(f, trace=DEFAULT_TRACE):
+    offset = f.tell()
+    ambient_color = struct.unpack("fff", f.read(4 * 3))  # GL_AMBIENT
+    diffuse_color = struct.unpack("fff", f.read(4 * 3))  # GL_DIFFUSE
+    specular_color = struct.unpack("fff", f.read(4 * 3))  # GL_SPECULAR
+    shininess, = struct.unpack("f", f.read(4))  # GL_SHININESS
     alpha_constant, = struct.unpack("f", f.read(4))
-    print("# Alpha constant", alpha_constant)
-    material_id, = struct.unpack("<I", f.read(4))
-    print("# Material id", material_id)  # saved at 005CE8A6
-    print("# End material", "0x%x" % f.tell())
+    material_id, = struct.unpack("<I", f.read(4))  # saved at 005CE8A6
 
     material = {"material_id": material_id, "ambient_color": ambient_color, "diffuse_color": diffuse_color,
                 "specular_color": specular_color, "shininess": shininess, "alpha_constant": alpha_constant}
+    if trace.level >= TRACE_DETAIL:
+        trace.emit(TRACE_DETAIL, "material", offset=offset, **material)
     return material
 
 
+class BufferReader:
+    """Read only file like object over any bytes like object, e.g. a memoryview of a brz entry.
+    The buffer is never copied as a whole, only the slices that are read."""
+    def __init__(self, buf, name="<buffer>"):
+        self.view = memoryview(buf)
+        self.name = name
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            end = len(self.view)
+        else:
+            end = min(self.pos + size, len(self.view))
+        data = self.view[self.pos:end].tobytes()
+        self.pos = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        target = memoryview(b).cast("B")
+        end = min(self.pos + len(target), len(self.view))
+        size = end - self.pos
+        target[:size] = self.view[self.pos:end]
+        self.pos = end
+        return size
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class MDR:
-    def __init__(self, filepath, base_name, dump_manifest=False, parse_only=False, verbose=False):
+    def __init__(self, filepath, base_name, dump_manifest=False, parse_only=False, verbose=False, trace=None):
         self.filepath = filepath
         self.base_name = base_name
         self.parse_only = parse_only
         self.verbose = verbose
         self.objects = []
+        if trace is None:
+            trace = Trace(TRACE_DETAIL if verbose else TRACE_WARNING)
+        self.trace = trace
 
         #in the binary file
         self.num_models = 0
 
-    def read(self, outdir):
-        with open(self.filepath, "rb") as f:
+    def read(self, outdir, buf=None, lazy=False):
+        """Parse the file at filepath, or buf if it is given. buf can be any bytes like object
+        such as a memoryview of a brz entry, in that case filepath is only used as a name.
+        With lazy=True only the section offsets of every object are read, the file is memory mapped
+        and the geometry arrays are decoded from it when they are first used. A buf given with
+        lazy=True has to stay valid as long as the objects are used."""
+        if lazy and buf is None:
+            with open(self.filepath, "rb") as fh:
+                buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if buf is None:
+            source = open(self.filepath, "rb")
+        else:
+            source = BufferReader(buf, self.filepath)
+        with source as f:
             self.num_models, = struct.unpack("<I", f.read(4))  # read from 008A04D8
-            print("# number of models", self.num_models)
+            self.trace.emit(TRACE_SECTION, "file", name=self.filepath, models=self.num_models)
             for i in range(0, self.num_models):
                 mdr_obj = MDRObject()
-                mdr_obj.read(self.base_name, self.num_models, f, i, outdir, not self.parse_only, self.verbose)
+                mdr_obj.read(self.base_name, self.num_models, f, i, outdir, not self.parse_only, self.verbose, self.trace,
+                             lazy)
+                if lazy:
+                    mdr_obj.source = buf
                 self.objects.append(mdr_obj)
 
     def write(self, filepath):
+        """Serialize all objects into one buffer and write it with a single call.
+        Objects whose faces use more vertices than 16 bit indices address are split, see MDRObject.split."""
+        self.num_models = len(self.objects)
+        objects = []
+        for o in self.objects:
+            pieces = o.split()
+            if len(pieces) > 1:
+                self.trace.warning("%s has %i vertices, written as %i submodels" % (o.name, len(o.vertex_array),
+                                                                                    len(pieces)), name=o.name)
+            objects.extend(pieces)
+        parts = [struct.pack("<I", len(objects))]
+        for o in objects:
+            o.pack(parts)
         with open(filepath, "wb") as f:
-            self.num_models = len(self.objects)
-            f.write(struct.pack("<I", self.num_models))
-
-            for o in self.objects:
-                f.write(struct.pack('x'))
-                f.write(struct.pack("<H", len(o.name)))
-                f.write(struct.pack("%is" % len(o.name), o.name))
-                f.write(struct.pack("b", 2))  # unk0
-                #TODO write out foliage_meta
-                if len(o.meta_data1) != 0:
-                    for i in range(0, 11):
-                        f.write(struct.pack("f", o.meta_data1[i]))
-                    if len(o.meta_data2) != 0:
-                        for i in range(0, 24):
-                            print("writing", o.meta_data2[i])
-                            f.write(struct.pack("f", o.meta_data2[i]))
-                        # f.write(struct.pack('x' * 12))
-                        f.write(struct.pack("fff", *o.meta_data_unk1))
+            f.write(b"".join(parts))
+
+
+# face indices are written as u16
+MAX_VERTICES = 0x10000
+
+# geometry sections: element type and number of elements per row
+GEOMETRY_SECTIONS = {"indices": ("<u2", 3), "uvs": ("<f4", 2), "vertices": ("<f4", 3), "normals": ("<i2", 3)}
+
+
+def _geometry_array(section):
+    """Geometry attribute stored as one contiguous (n, width) array. A lazily read MDRObject decodes
+    it from its source buffer on first access. Assigned sequences, e.g. lists of tuples from Blender,
+    are converted to the file's element type. Face indices that do not fit in 16 bits are kept as
+    32 bit so MDR.write can split the mesh instead of silently truncating them."""
+    attr = "_" + section
+    dtype, width = GEOMETRY_SECTIONS[section]
+
+    def get(self):
+        value = getattr(self, attr)
+        if value is None:
+            offset, length = self.sections[section]
+            count, = struct.unpack_from("<I", self.source, offset)
+            value = np.frombuffer(self.source, dtype=dtype, count=int(count / width) * width,
+                                  offset=offset + 4).reshape(-1, width)
+            setattr(self, attr, value)
+        return value
+
+    def set(self, value):
+        if value is not None:
+            if section == "indices":
+                value = np.asarray(value)
+                if value.dtype != np.dtype(dtype):
+                    if value.size != 0 and value.max() > 0xffff:
+                        value = value.astype("<u4")
                     else:
-                        f.write(struct.pack('x' * 108))
-                else:
-                    f.write(struct.pack("f", 1.0))  # if the next 176 bytes are all 0, the object can not be moved in the editor
-                    f.write(struct.pack('x' * 148))
-                f.write(struct.pack("ff", o.bbox_x_min, o.bbox_x_max))
-                f.write(struct.pack("ff", o.bbox_y_min, o.bbox_y_max))
-                f.write(struct.pack("ff", o.bbox_z_min, o.bbox_z_max))
-                f.write(struct.pack("<I", 3*len(o.index_array)))
-                for idx in o.index_array:
-                    f.write(struct.pack("<HHH", idx[0], idx[1], idx[2]))
-                f.write(struct.pack("<I", 2*len(o.uv_array)))
-                for uv in o.uv_array:
-                    f.write(struct.pack("<ff", uv[0], uv[1]))
-                f.write(struct.pack('<I', len(o.uv_array)-1))  # last uv index
-
-                f.write(struct.pack('xx'))  # some unknown
-                f.write(struct.pack("<H", len(o.parent_name)))
-                if len(o.parent_name) > 0:
-                    f.write(struct.pack("%is" % len(o.parent_name), o.parent_name))
-
-                write_matrix(o.transform_matrix, f)
-                write_matrix(o.inverse_transform_matrix, f)
-
-                f.write(struct.pack("<I", len(o.anchor_points)))
-                for anchor in o.anchor_points:
-                    name, m = anchor
-                    f.write(struct.pack("<H", len(name)))
-                    f.write(struct.pack("%is" % len(name), name))
-                    write_matrix(m, f)
-
-                f.write(struct.pack(60 * 'x'))  # unknown
-
-                f.write(struct.pack("fff", 1.0, 1.0, 1.0))  # ambient color is hard coded to white
-                f.write(struct.pack("fff", *o.material["diffuse_color"]))
-                f.write(struct.pack("fff", *o.material["specular_color"]))
-                f.write(struct.pack("f", o.material["shininess"]))
-                f.write(struct.pack("f", o.material["alpha_constant"]))
-                f.write(struct.pack("I", o.material["material_id"]))
-
-                f.write(struct.pack("<H", len(o.texture_name)))
-                f.write(struct.pack("%is" % len(o.texture_name), o.texture_name))
-                f.write(struct.pack("b", 2))  # unk3
-                if len(o.meta_data3) != 0:
-                    for i in range(0, 35):
-                        f.write(struct.pack("f", o.meta_data3[i]))
-                    # f.write(struct.pack('x' * 12))
-                    f.write(struct.pack("fff", *o.meta_data_unk2))
-                else:
-                    f.write(struct.pack("f", 1.0))  # if the next 176 bytes are all 0, the object can not be moved in the editor
-                    f.write(struct.pack('x' * 148))
-                f.write(struct.pack("ff", o.bbox_x_min, o.bbox_x_max))
-                f.write(struct.pack("ff", o.bbox_y_min, o.bbox_y_max))
-                f.write(struct.pack("ff", o.bbox_z_min, o.bbox_z_max))
-                f.write(struct.pack("<I", 3*len(o.vertex_array)))
-                for vert in o.vertex_array:
-                    f.write(struct.pack("<fff", vert[0], vert[1], vert[2]))
-                f.write(struct.pack("<I", 3*len(o.vertex_normal_array)))
-                for norm in o.vertex_normal_array:
-                    f.write(struct.pack("<hhh", norm[0], norm[1], norm[2]))
-                f.write(struct.pack("<I", 0))  # no footer
+                        value = value.astype(dtype)
+            else:
+                value = np.asarray(value, dtype=dtype)
+            value = value.reshape(-1, width)
+        setattr(self, attr, value)
+    return property(get, set)
+
+
+def _float_block(name):
+    """Fixed size metadata block stored as a float32 array, empty or None when the block is absent."""
+    attr = "_" + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        if value is not None:
+            value = np.asarray(value, dtype="<f4").ravel()
+        setattr(self, attr, value)
+    return property(get, set)
 
 
 class MDRObject:
     """MDR object
+    Geometry lives in contiguous numpy arrays and metadata blocks in fixed size float32 arrays.
+    The arrays index, iterate and len() like the lists of tuples used before, so existing consumers
+    keep working, call tolist() on them where plain Python numbers are needed.
     """
+    __slots__ = ("base_name", "name", "parent_name", "_indices", "_uvs", "_vertices", "_normals", "sections", "source",
+                 "texture_name", "material", "anchor_points", "bbox_x_min", "bbox_x_max", "bbox_y_min", "bbox_y_max",
+                 "bbox_z_min", "bbox_z_max", "transform_matrix", "inverse_transform_matrix", "foliage_meta",
+                 "_meta_data1", "_meta_data2", "_meta_data3", "_meta_data_unk1", "_meta_data_unk2", "var_float")
+
+    index_array = _geometry_array("indices")  # [ (i,i,i) ...]
+    uv_array = _geometry_array("uvs")  # [ (f,f) ...]
+    vertex_array = _geometry_array("vertices")  # [ (f,f,f) ...]
+    vertex_normal_array = _geometry_array("normals")  # [ (i16,i16,i16) ...]
+    meta_data1 = _float_block("meta_data1")  # 11 floats
+    meta_data2 = _float_block("meta_data2")  # 24 floats
+    meta_data3 = _float_block("meta_data3")  # 35 floats
+    meta_data_unk1 = _float_block("meta_data_unk1")  # 3 floats
+    meta_data_unk2 = _float_block("meta_data_unk2")  # 3 floats
+
     def __init__(self):
         """The constructor takes a model name as parameter. All other variables are set
         directly.
@@ -195,10 +332,12 @@ class MDRObject:
         self.base_name = ""
         self.name = ""
         self.parent_name = ""
-        self.index_array = []   # [ (i,i,i) ...]
-        self.uv_array = []      # [ (f,f) ...]        
-        self.vertex_array = []  # [ (f,f,f) ...]
-        self.vertex_normal_array = []  # [ (i16,i16,i16) ...]
+        self.index_array = []
+        self.uv_array = []
+        self.vertex_array = []
+        self.vertex_normal_array = []
+        self.sections = {}  # section name -> (offset, length) in the file
+        self.source = None  # buffer the geometry of a lazily read object is decoded from
         self.texture_name = ""
         self.material = {}
         self.anchor_points = []  # [ (name, matrix) ...]
@@ -211,8 +350,136 @@ class MDRObject:
         self.transform_matrix = None
         self.inverse_transform_matrix = None
         self.foliage_meta = {}
-
-    def read(self, base_name, num_models, f, model_number, outdir, dump=True, verbose=False):
+        self.meta_data1 = []
+        self.meta_data2 = []
+        self.meta_data3 = []
+        self.meta_data_unk1 = None
+        self.meta_data_unk2 = None
+        self.var_float = 1.0
+
+    def pack(self, parts):
+        """Append the binary form of this object to the list of byte strings parts."""
+        parts.append(b"\0")
+        parts.append(string_bytes(self.name))
+        parts.append(struct.pack("b", 2))  # unk0
+        #TODO write out foliage_meta
+        if len(self.meta_data1) != 0:
+            parts.append(struct.pack("11f", *self.meta_data1[:11]))
+            if len(self.meta_data2) != 0:
+                parts.append(struct.pack("24f", *self.meta_data2[:24]))
+                parts.append(struct.pack("fff", *self.meta_data_unk1))
+            else:
+                parts.append(b"\0" * 108)
+        else:
+            parts.append(struct.pack("f", 1.0))  # if the next 176 bytes are all 0, the object can not be moved in the editor
+            parts.append(b"\0" * 148)
+        bbox = struct.pack("ffffff", self.bbox_x_min, self.bbox_x_max, self.bbox_y_min, self.bbox_y_max,
+                           self.bbox_z_min, self.bbox_z_max)
+        parts.append(bbox)
+        if self.index_array.dtype != np.dtype("<u2"):
+            raise ValueError("%s has vertex indices that do not fit in 16 bits" % self.name)
+        parts.append(array_bytes(self.index_array, "<u2", 3))
+        parts.append(array_bytes(self.uv_array, "<f4", 2))
+        parts.append(struct.pack("<I", len(self.uv_array)-1))  # last uv index
+
+        parts.append(b"\0\0")  # some unknown
+        parts.append(string_bytes(self.parent_name))
+
+        parts.append(matrix_bytes(self.transform_matrix))
+        parts.append(matrix_bytes(self.inverse_transform_matrix))
+
+        parts.append(struct.pack("<I", len(self.anchor_points)))
+        for name, m in self.anchor_points:
+            parts.append(string_bytes(name))
+            parts.append(matrix_bytes(m))
+
+        parts.append(b"\0" * 60)  # unknown
+
+        parts.append(struct.pack("fff", 1.0, 1.0, 1.0))  # ambient color is hard coded to white
+        parts.append(struct.pack("fff", *self.material["diffuse_color"]))
+        parts.append(struct.pack("fff", *self.material["specular_color"]))
+        parts.append(struct.pack("f", self.material["shininess"]))
+        parts.append(struct.pack("f", self.material["alpha_constant"]))
+        parts.append(struct.pack("I", self.material["material_id"]))
+
+        parts.append(string_bytes(self.texture_name))
+        parts.append(struct.pack("b", 2))  # unk3
+        if len(self.meta_data3) != 0:
+            parts.append(struct.pack("35f", *self.meta_data3[:35]))
+            parts.append(struct.pack("fff", *self.meta_data_unk2))
+        else:
+            parts.append(struct.pack("f", 1.0))  # if the next 176 bytes are all 0, the object can not be moved in the editor
+            parts.append(b"\0" * 148)
+        parts.append(bbox)
+        parts.append(array_bytes(self.vertex_array, "<f4", 3))
+        parts.append(array_bytes(self.vertex_normal_array, "<i2", 3))
+        parts.append(struct.pack("<I", 0))  # no footer
+
+    def split(self, max_vertices=MAX_VERTICES):
+        """Return this object as a list of objects whose faces use at most max_vertices vertices each.
+        Faces are taken in order and a piece ends before the face that would need one vertex too many,
+        every piece gets its vertices, uvs and normals compacted and its indices remapped. The first
+        piece keeps the name and anchor points, so children still find their parent, the others are
+        named <name>_split<n>. All pieces keep the parent, transforms, material, texture, metadata and
+        bounding box, so every piece keeps the original's pivot and its model space vertices stay put.
+        An object that fits is returned as is."""
+        indices = np.asarray(self.index_array).reshape(-1, 3)
+        if indices.size == 0 or int(indices.max()) < max_vertices:
+            return [self]
+        pieces = []
+        start = 0
+        while start < len(indices):
+            window = indices[start:start + 8 * max_vertices].ravel()
+            unique, first = np.unique(window, return_index=True)
+            is_new = np.zeros(len(window), dtype=np.int64)
+            is_new[first] = 1
+            distinct = np.cumsum(is_new)[2::3]  # vertices used after each face of the window
+            faces = int(np.searchsorted(distinct, max_vertices, side="right"))
+            if faces == 0:
+                raise ValueError("%s: max_vertices %i is too small for a triangle" % (self.name, max_vertices))
+            pieces.append(self.piece(indices[start:start + faces], len(pieces)))
+            start += faces
+        return pieces
+
+    def piece(self, faces, number):
+        """New object with the given faces of this one and only the vertices they use, see split."""
+        used, remapped = np.unique(faces, return_inverse=True)
+        ob = MDRObject()
+        for name in ("base_name", "parent_name", "material", "texture_name", "bbox_x_min", "bbox_x_max",
+                     "bbox_y_min", "bbox_y_max", "bbox_z_min", "bbox_z_max", "foliage_meta", "meta_data1",
+                     "meta_data2", "meta_data3", "meta_data_unk1", "meta_data_unk2", "transform_matrix",
+                     "inverse_transform_matrix", "var_float"):
+            setattr(ob, name, getattr(self, name))
+        ob.index_array = remapped.reshape(-1, 3).astype("<u2")
+        ob.vertex_array = np.asarray(self.vertex_array)[used]
+        if len(self.uv_array) > used[-1]:
+            ob.uv_array = np.asarray(self.uv_array)[used]
+        if len(self.vertex_normal_array) > used[-1]:
+            ob.vertex_normal_array = np.asarray(self.vertex_normal_array)[used]
+        if number == 0:
+            ob.name = self.name
+            ob.anchor_points = self.anchor_points
+        else:
+            suffix = "_split%i" % number
+            ob.name = self.name + (suffix.encode("ascii") if isinstance(self.name, bytes) else suffix)
+        return ob
+
+    def end_section(self, name, start, f, trace, **fields):
+        length = f.tell() - start
+        self.sections[name] = (start, length)
+        trace.section(name, start, length, **fields)
+
+    def count(self, section):
+        """Number of rows in a geometry section, a lazy object only reads the count in front of it."""
+        value = getattr(self, "_" + section)
+        if value is None:
+            count, = struct.unpack_from("<I", self.source, self.sections[section][0])
+            return int(count / GEOMETRY_SECTIONS[section][1])
+        return len(value)
+
+    def read(self, base_name, num_models, f, model_number, outdir, dump=True, verbose=False, trace=DEFAULT_TRACE, lazy=False):
+        """Parse one object at the current position of f. With lazy=True only the offsets of the
+        geometry sections are recorded and the arrays are decoded from source on first access."""
         ########
         # object:
         # face indices
@@ -223,133 +490,110 @@ class MDRObject:
         # normals
         ####
         self.base_name = base_name
-        print("# Start model %i" % model_number, "at 0x%x" % f.tell(),
-              "##############################################################")
+        model_offset = f.tell()
         f.read(1)  # read at 004537A0
         name_length, = struct.unpack("<H", f.read(2))
-        print("# submodel name length:", name_length)
         self.name = f.read(name_length).decode("ascii")  # saved at 0073E054
-        print("# submodel name:", self.name)
+        self.end_section("name", model_offset, f, trace, model=model_number, value=self.name)
 
-        print("# Start collision metadata")
         self.meta_data1 = []
         self.meta_data2 = []
         self.meta_data3 = []
         self.meta_data_unk1 = None
         self.meta_data_unk2 = None
+        # collision metadata
         # read one byte, but it is saved as 4 byte in memory
+        start = f.tell()
         unk0, = struct.unpack("b", f.read(1))  # saved at 004539BB
-        print("# 0x%x %i" % (f.tell() - 1, unk0))
         if unk0 != 2:
-            error_message = "unk0 is %s, not 2, 0x%x %s, %s, %s" % (
-            unk0, f.tell() - 1, base_name, self.name, model_number)
             # raise ValueError(error_message)
-            print(error_message)
-        # else:
-        #     print("unk0 is %s (always 2?) 0x%x %s, %s, %s" % (unk0, f.tell() - 1, base_name, self.name, model_number))
-
-        print("# Start unknown section of 176 bytes, has something to do with collision box", "0x%x" % f.tell())
+            trace.warning("unk0 is %s, not 2" % unk0, offset=f.tell() - 1, file=base_name, model=model_number, name=self.name)
 
+        # unknown section of 176 bytes, has something to do with collision box
         # start reading at 004539D1
-        for i in range(0, 11):
-            unk, = struct.unpack("f", f.read(4))
-            self.meta_data1.append(unk)
-            if verbose:
-                print("# 0x%x [%i] %f" % (f.tell()-4, i, unk))
-
-        if verbose:
-            print("################")
-
+        self.meta_data1 = read_array(f, "<f4", 1, 11)
         # loop at 00453ACF
-        for i in range(0, 6):
-            for j in range(0, 4):
-                unk, = struct.unpack("f", f.read(4))
-                self.meta_data2.append(unk)
-                if verbose:
-                    print("# 0x%x [%i] %f" % (f.tell()-4, i, unk))
-
-        unk = struct.unpack("fff", f.read(12))
-        self.meta_data_unk1 = unk
-        print("# 0x%x %f %f %f (unk)" % (f.tell() - 12, *unk))  # saved at 00453B3C
+        self.meta_data2 = read_array(f, "<f4", 1, 24)
+        self.meta_data_unk1 = read_array(f, "<f4", 1, 3)  # saved at 00453B3C
         self.bbox_x_min, self.bbox_x_max, self.bbox_y_min, self.bbox_y_max, self.bbox_z_min, self.bbox_z_max = struct.unpack("ffffff", f.read(24))  # saved at 00453B4C
-        print("# Bound box min/max")
-        print("# xmin ", self.bbox_x_min)
-        print("# xmax ", self.bbox_x_max)
-        print("# ymin ", self.bbox_y_min)
-        print("# ymax ", self.bbox_y_max)
-        print("# zmin ", self.bbox_z_min)
-        print("# zmax ", self.bbox_z_max)
-        print("# Finished unknown section", "0x%x" % f.tell())
+        self.end_section("metadata", start, f, trace, model=model_number)
+        if trace.level >= TRACE_DETAIL:
+            trace.emit(TRACE_DETAIL, "meta_data1", value=self.meta_data1)
+            trace.emit(TRACE_DETAIL, "meta_data2", value=self.meta_data2)
+            trace.emit(TRACE_DETAIL, "meta_data_unk1", value=self.meta_data_unk1)
+            trace.emit(TRACE_DETAIL, "bbox", value=(self.bbox_x_min, self.bbox_x_max, self.bbox_y_min,
+                                                     self.bbox_y_max, self.bbox_z_min, self.bbox_z_max))
 
         ###############################################
-        print("# Start face vertex indices at 0x%x" % f.tell())
+        start = f.tell()
         face_count, = struct.unpack("<I", f.read(4))  # read at 004537C5
-        print("# Face count:", int(face_count / 3))
-
-        for i in range(0, int(face_count / 3)):  # read at 0045397B
-            if not dump:
-                f.read(6)
-            else:
-                v0, v1, v2 = struct.unpack("<HHH", f.read(6))
-                # print("f %i/%i %i/%i %i/%i" % (v0+1,v0+1,v1+1,v1+1,v2+1,v2+1))
-                self.index_array.append((v0, v1, v2))
-        print("# Finished face vertex indices", "0x%x" % f.tell())
+        # read at 0045397B
+        if lazy:
+            self.index_array = None
+        if not dump or lazy:
+            f.seek(int(face_count / 3) * 6, 1)
+        else:
+            self.index_array = read_array(f, "<u2", int(face_count / 3), 3)
+        self.end_section("indices", start, f, trace, model=model_number, count=int(face_count / 3))
         ###############################################
 
         ###############################################
-        print("# Start UVs at 0x%x" % f.tell())
+        start = f.tell()
         uv_in_section, = struct.unpack("<I", f.read(4))
-        print("# UV in section:", int(uv_in_section / 2))
-
-        for i in range(0, int(uv_in_section / 2)):  # read at 00453965
-            if not dump:
-                f.read(8)
-            else:
-                u, v = struct.unpack("<ff", f.read(8))
-                self.uv_array.append((u, v))
-                if verbose:
-                    print("# vt", i, u,v)
-        print("# Finish UV section:", "0x%x" % f.tell())
+        # read at 00453965
+        if lazy:
+            self.uv_array = None
+        if not dump or lazy:
+            f.seek(int(uv_in_section / 2) * 8, 1)
+        else:
+            self.uv_array = read_array(f, "<f4", int(uv_in_section / 2), 2)
+            if trace.level >= TRACE_DETAIL:
+                for i, (u, v) in enumerate(self.uv_array.tolist()):
+                    trace.emit(TRACE_DETAIL, "vt", index=i, value=(u, v))
+        self.end_section("uvs", start, f, trace, model=model_number, count=int(uv_in_section / 2))
         ###############################################
 
-        print("# Start unknown section 1")
-        uv_last_index, = struct.unpack("<I", f.read(4))
-        print("# Last uv index %i" % uv_last_index, "at 0x%x" % (f.tell()-4))  # saved at 0045381B, right after UV data
+        start = f.tell()
+        uv_last_index, = struct.unpack("<I", f.read(4))  # saved at 0045381B, right after UV data
         if uv_last_index != uv_in_section/2 - 1:
-            print("Last uv index != uv_in_section/2 - 1")
+            trace.warning("Last uv index != uv_in_section/2 - 1", offset=start, file=base_name, model=model_number,
+                          name=self.name)
 
         count, = struct.unpack("<H", f.read(2))  # read at 00453826, used by CMSF2 for foliage metadata
-        print("# Unknown uint16 unk1 0x%x" % count, "at 0x%x" % (f.tell() - 4))
         if count != 0:
             for i in range(0, count):
                 length, = struct.unpack("<H", f.read(2))
                 meta_name = f.read(length).decode("ascii")
                 meta_count, = struct.unpack("<H", f.read(2))
                 meta_data = struct.unpack('b'*meta_count, f.read(meta_count))
-                print("# foliage_meta ", meta_name, *meta_data)
+                trace.emit(TRACE_DETAIL, "foliage_meta", name=meta_name, value=meta_data)
                 self.foliage_meta[meta_name] = meta_data
+        self.end_section("foliage_meta", start, f, trace, model=model_number, count=count)
 
+        start = f.tell()
         length, = struct.unpack("<H", f.read(2))
         self.parent_name = ""
         if length > 0:
             self.parent_name = f.read(length).decode("ascii")
-            print("# %s, parent name:" % self.name, self.parent_name, hex(f.tell()))
+        self.end_section("parent", start, f, trace, model=model_number, value=self.parent_name)
 
-        self.transform_matrix = read_matrix(f)  # read at 004532C1
-        self.inverse_transform_matrix = read_matrix(f)  # read at 004532D1
+        start = f.tell()
+        self.transform_matrix = read_matrix(f, trace)  # read at 004532C1
+        self.inverse_transform_matrix = read_matrix(f, trace)  # read at 004532D1
+        self.end_section("matrices", start, f, trace, model=model_number)
 
+        start = f.tell()
         anchor_point_count, = struct.unpack("<I", f.read(4))  # read at 004532DF
-        print("# Read 4 bytes, object count: ", anchor_point_count)
-
         for i in range(0, anchor_point_count):
             name_length, = struct.unpack("<H", f.read(2))
             anchor_name = f.read(name_length).decode("ascii")
-            print("Anchor point %i: %s" % (i, anchor_name))
-            m = read_matrix(f)  # read at 00453311
+            m = read_matrix(f, trace)  # read at 00453311
+            trace.emit(TRACE_DETAIL, "anchor", index=i, name=anchor_name)
             self.anchor_points.append((anchor_name, m))
-        print("# End list of anchor points", "0x%x" % f.tell())
+        self.end_section("anchors", start, f, trace, model=model_number, count=anchor_point_count)
 
-        print("# Start unknown data ", "0x%x" % f.tell())
+        # unknown data
+        start = f.tell()
         for i in range(0, 3):
             f.read(1)  # always 0, read at 00453347, saved at 0045335B
             f.read(1)  # always 0, read at 00453365, saved at 00453378
@@ -361,81 +605,70 @@ class MDRObject:
             f.read(1)  # read 1 at 004533EC
             f.read(4)  # read 4 at 00453407
             f.read(4)  # read 4 at 0045341C
+        self.end_section("unknown", start, f, trace, model=model_number)
 
-        print("# End unknown data ", "0x%x" % f.tell())
-        
-        self.material = read_material(f)  # read at 0045343F, sub_5CE790
+        start = f.tell()
+        self.material = read_material(f, trace)  # read at 0045343F, sub_5CE790
+        self.end_section("material", start, f, trace, model=model_number)
 
+        start = f.tell()
         name_length, = struct.unpack("<H", f.read(2))  # read in sub_73DE20, length of string
         texture_name = f.read(name_length).decode("ascii")  # read at 0073DEA3
-        print("# Texture name:", texture_name)
-        # print("Texture\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-        # self.material["material_id"], texture_name, self.material["ambient_color"], self.material["diffuse_color"],
-        # self.material["specular_color"], self.material["shininess"], self.material["alpha_constant"], self.name))
+        self.end_section("texture", start, f, trace, model=model_number, value=texture_name)
 
-        if dump:
+        if dump or lazy:
             self.texture_name = texture_name
         
+        start = f.tell()
         unk3, = struct.unpack("b", f.read(1))  # read at 00453462
         if unk3 != 2:
-            error_message = error_message = "unk3 is %s, not 2, 0x%x %s, %s, %s" % (
-            unk3, f.tell() - 1, base_name, self.name, model_number)
             # raise ValueError(error_message)
-            print(error_message)
-        else:
-            print("unk3 is %s (always 2?) 0x%x %s, %s, %s" % (unk3, f.tell() - 1, base_name, self.name, model_number))
+            trace.warning("unk3 is %s, not 2" % unk3, offset=f.tell() - 1, file=base_name, model=model_number, name=self.name)
         # read 4, 11 starting at 0045347B
-        print("# Start unknown section of 176 bytes, has something to do with collision box", "0x%x" % f.tell())
-        for i in range(0, 35):
-            unk, = struct.unpack("f", f.read(4))
-            self.meta_data3.append(unk)
-            if verbose:
-                print("# 0x%x [%i] %f" % (f.tell() - 4, i, unk))
-        unk = struct.unpack("fff", f.read(12))  # read at 004535D7
-        self.meta_data_unk2 = unk
-        print("# 0x%x %f %f %f" % (f.tell() - 12, *unk))  # read at 004535D7
-        self.bbox_x_min, self.bbox_x_max, self.bbox_y_min, self.bbox_y_max, self.bbox_z_min, self.bbox_z_max = struct.unpack("ffffff", f.read(24))
-        print("# Bound box min/max")  # read at 004535E7
-        print("# xmin ", self.bbox_x_min)
-        print("# xmax ", self.bbox_x_max)
-        print("# ymin ", self.bbox_y_min)
-        print("# ymax ", self.bbox_y_max)
-        print("# zmin ", self.bbox_z_min)
-        print("# zmax ", self.bbox_z_max)
-        print("# Finished unknown section", "0x%x" % f.tell())
-
-        print("# Start vertices at 0x%x" % f.tell())
+        # unknown section of 176 bytes, has something to do with collision box
+        self.meta_data3 = read_array(f, "<f4", 1, 35)
+        self.meta_data_unk2 = read_array(f, "<f4", 1, 3)  # read at 004535D7
+        self.bbox_x_min, self.bbox_x_max, self.bbox_y_min, self.bbox_y_max, self.bbox_z_min, self.bbox_z_max = struct.unpack("ffffff", f.read(24))  # read at 004535E7
+        self.end_section("metadata3", start, f, trace, model=model_number)
+        if trace.level >= TRACE_DETAIL:
+            trace.emit(TRACE_DETAIL, "meta_data3", value=self.meta_data3)
+            trace.emit(TRACE_DETAIL, "meta_data_unk2", value=self.meta_data_unk2)
+            trace.emit(TRACE_DETAIL, "bbox", value=(self.bbox_x_min, self.bbox_x_max, self.bbox_y_min,
+                                                     self.bbox_y_max, self.bbox_z_min, self.bbox_z_max))
+
+        start = f.tell()
         vertex_floats, = struct.unpack("<I", f.read(4))  # read at 004535FB
-        print("# Vertex count:", int(vertex_floats / 3))
-
-        for i in range(0, int(vertex_floats / 3)):  # read at 0045373D
-            if not dump:
-                f.read(12)
-            else:
-                x, y, z = struct.unpack("fff", f.read(12))
-                self.vertex_array.append((x, y, z))
-        print("# End vertices", "0x%x" % f.tell())
+        # read at 0045373D
+        if lazy:
+            self.vertex_array = None
+        if not dump or lazy:
+            f.seek(int(vertex_floats / 3) * 12, 1)
+        else:
+            self.vertex_array = read_array(f, "<f4", int(vertex_floats / 3), 3)
+        self.end_section("vertices", start, f, trace, model=model_number, count=int(vertex_floats / 3))
 
-        print("# Start vertex normals at 0x%x" % f.tell())
+        start = f.tell()
         normal_count, = struct.unpack("<I", f.read(4))  # read at 0045361D
-        print("# Normals count:", int(normal_count / 3))  # 3 per vertex
-
-        for i in range(0, int(normal_count / 3)):  # read at 00453727
-            if not dump:
-                f.read(6)
-            else:
-                nx, ny, nz = struct.unpack("<hhh", f.read(6))
-                if verbose:
-                    print("# vn [%i] %i %i %i" % (i, nx, ny, nz))
-                self.vertex_normal_array.append((nx, ny, nz))
-        print("# End normals", "0x%x" % f.tell())
+        # read at 00453727
+        if lazy:
+            self.vertex_normal_array = None
+        if not dump or lazy:
+            f.seek(int(normal_count / 3) * 6, 1)
+        else:
+            self.vertex_normal_array = read_array(f, "<i2", int(normal_count / 3), 3)
+            if trace.level >= TRACE_DETAIL:
+                for i, (nx, ny, nz) in enumerate(self.vertex_normal_array.tolist()):
+                    trace.emit(TRACE_DETAIL, "vn", index=i, value=(nx, ny, nz))
+        self.end_section("normals", start, f, trace, model=model_number, count=int(normal_count / 3))
 
+        start = f.tell()
         footer_counter, = struct.unpack("<I", f.read(4))  # read at 00453649
         if footer_counter != 0:
-            print("# Parsing footer, count:", footer_counter)
-            print(f.name, self.name)
+            trace.warning("Parsing footer, count: %i" % footer_counter, offset=start, file=f.name, name=self.name)
             for i in range(0, footer_counter):
-                print(struct.unpack("<fff", f.read(12)))
+                value = struct.unpack("<fff", f.read(12))
+                trace.emit(TRACE_DETAIL, "footer", index=i, value=value)
                 length, = struct.unpack("<I", f.read(4))
                 f.read(length * 4)
-        print("# End model 0x%x ##############################################################" % f.tell())
+        self.end_section("footer", start, f, trace, model=model_number, count=footer_counter)
+        self.end_section("model", model_offset, f, trace, model=model_number, value=self.name)
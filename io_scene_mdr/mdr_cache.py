@@ -0,0 +1,266 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Script copyright (C) Stanislav Bobovych
+# Contributors: Stanislav Bobovych
+
+"""
+Cache of parsed MDR files.
+
+Every parsed file is stored as an uncompressed .npz: one .npy member per array plus a JSON
+member with names, materials and the other small fields. The members are stored, not deflated,
+so a cached file is memory mapped and its arrays are views into the map, a warm read never runs
+the MDR parser.
+"""
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+try:
+    from .mdr import MDRObject
+except ImportError:
+    from mdr import MDRObject
+
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# local file header of a zip member, see APPNOTE.TXT 4.3.7
+_ZIP_LOCAL_HEAD = struct.Struct("<IHHHHHIIIHH")
+_ZIP_LOCAL_MAGIC = 0x04034b50
+
+_ARRAYS = ("index_array", "uv_array", "vertex_array", "vertex_normal_array", "transform_matrix",
+           "inverse_transform_matrix", "meta_data1", "meta_data2", "meta_data3", "meta_data_unk1", "meta_data_unk2")
+_MATRICES = ("transform_matrix", "inverse_transform_matrix")
+_FIELDS = ("base_name", "name", "parent_name", "texture_name", "bbox_x_min", "bbox_x_max", "bbox_y_min",
+           "bbox_y_max", "bbox_z_min", "bbox_z_max", "var_float")
+
+
+def default_cache_dir():
+    """Per user directory where parsed MDR files are cached."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "cm2tools", "mdr")
+
+
+def content_key(data):
+    """Cache key of the raw bytes of an MDR file."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def stat_key(path):
+    """Cache key of a file on disk from its path, size and modification time, the file is not read."""
+    stat = os.stat(path)
+    key = "%s\0%i\0%i" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def file_key(path):
+    """Cache key of the content of a file on disk."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return content_key(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return content_key(data)
+
+
+def _tuples(value):
+    """JSON turns tuples into lists, the parser hands out tuples."""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def dump_objects(objects):
+    """Flatten parsed objects into a dict of arrays suitable for np.savez. The arrays of all
+    objects are concatenated per attribute so the archive has a handful of members however
+    many objects the file has, the header records how many rows belong to each object."""
+    header = {"version": CACHE_VERSION, "objects": []}
+    columns = {name: [] for name in _ARRAYS + ("anchors",)}
+    for ob in objects:
+        info = {name: getattr(ob, name) for name in _FIELDS}
+        info["material"] = ob.material
+        info["foliage_meta"] = ob.foliage_meta
+        info["sections"] = ob.sections
+        info["anchors"] = [name for name, m in ob.anchor_points]
+        info["rows"] = {}
+        for name in _ARRAYS:
+            value = getattr(ob, name)
+            if value is None:
+                info["rows"][name] = None
+            else:
+                value = np.asarray(value)
+                if name in _MATRICES:
+                    value = value[np.newaxis]
+                info["rows"][name] = len(value)
+                columns[name].append(value)
+        columns["anchors"].extend(np.asarray(m)[np.newaxis] for name, m in ob.anchor_points)
+        header["objects"].append(info)
+    arrays = {name: np.concatenate(values) for name, values in columns.items() if values}
+    arrays["header"] = np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8)
+    return arrays
+
+
+def load_objects(arrays):
+    """Rebuild MDRObjects from a mapping of array name to array, the inverse of dump_objects."""
+    header = json.loads(bytes(arrays["header"]).decode("utf-8"))
+    if header["version"] != CACHE_VERSION:
+        raise ValueError("cache version %s, expected %s" % (header["version"], CACHE_VERSION))
+    positions = dict.fromkeys(_ARRAYS + ("anchors",), 0)
+    objects = []
+    for info in header["objects"]:
+        ob = MDRObject()
+        for name in _FIELDS:
+            setattr(ob, name, info[name])
+        ob.material = {key: _tuples(value) for key, value in info["material"].items()}
+        ob.foliage_meta = {key: _tuples(value) for key, value in info["foliage_meta"].items()}
+        ob.sections = {key: tuple(value) for key, value in info["sections"].items()}
+        for name in _ARRAYS:
+            rows = info["rows"][name]
+            if rows is None:
+                setattr(ob, name, None)
+                continue
+            start = positions[name]
+            positions[name] = start + rows
+            value = arrays[name][start:start + rows]
+            if name in _MATRICES:
+                value = value[0]
+            setattr(ob, name, value)
+        start = positions["anchors"]
+        positions["anchors"] = start + len(info["anchors"])
+        if info["anchors"]:
+            ob.anchor_points = list(zip(info["anchors"], arrays["anchors"][start:positions["anchors"]]))
+        objects.append(ob)
+    return objects
+
+
+def map_npz(path):
+    """Memory map an uncompressed .npz and return {name: array}, the arrays are read only views into the map."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        members = zipfile.ZipFile(f).infolist()
+    arrays = {}
+    for member in members:
+        if member.compress_type != zipfile.ZIP_STORED:
+            raise ValueError("%s: member %s is compressed" % (path, member.filename))
+        head = _ZIP_LOCAL_HEAD.unpack_from(data, member.header_offset)
+        if head[0] != _ZIP_LOCAL_MAGIC:
+            raise ValueError("%s: bad local header for %s" % (path, member.filename))
+        start = member.header_offset + _ZIP_LOCAL_HEAD.size + head[9] + head[10]
+        npy = io.BytesIO(data[start:start + min(member.file_size, 4096)])
+        version = np.lib.format.read_magic(npy)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy)
+        else:
+            raise ValueError("%s: member %s has npy version %s" % (path, member.filename, version))
+        if dtype.hasobject:
+            raise ValueError("%s: member %s holds Python objects" % (path, member.filename))
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=start + npy.tell())
+        arrays[os.path.splitext(member.filename)[0]] = array.reshape(shape, order="F" if fortran_order else "C")
+    return arrays
+
+
+class MDRCache:
+    """Directory of parsed MDR files. Entries are keyed by content hash, or with by_stat=True by
+    path, size and mtime which avoids reading the file on a hit. The directory is kept under
+    max_bytes by removing the least recently used entries, a hit refreshes the entry's mtime."""
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, by_stat=False):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.by_stat = by_stat
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def key(self, mdr, buf=None):
+        if buf is not None:
+            return content_key(buf)
+        if self.by_stat:
+            return stat_key(mdr.filepath)
+        return file_key(mdr.filepath)
+
+    def read(self, mdr, outdir, buf=None):
+        """Fill mdr.objects from the cache, or parse with mdr.read and store the result.
+        Files read with parse_only are passed through, they do not decode the geometry."""
+        if mdr.parse_only:
+            mdr.read(outdir, buf)
+            return False
+        key = self.key(mdr, buf)
+        path = self.entry_path(key)
+        try:
+            objects = load_objects(map_npz(path))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            objects = None
+        if objects is not None:
+            for ob in objects:
+                ob.base_name = mdr.base_name
+            mdr.objects.extend(objects)
+            mdr.num_models = len(objects)
+            self.hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return True
+        self.misses += 1
+        mdr.read(outdir, buf)
+        self.store(key, mdr.objects)
+        return False
+
+    def store(self, key, objects):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.entry_path(key)
+        tmp_path = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **dump_objects(objects))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the directory fits in max_bytes."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,249 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Script copyright (C) Stanislav Bobovych
+# Contributors: Stanislav Bobovych
+
+"""
+Binary glTF 2.0 (.glb) export of parsed MDR files.
+
+Every MDRObject becomes a node with a mesh, nodes are parented by parent_name and anchor points
+become child nodes. MDR vertices and anchor matrices are stored in model space, the transform of an
+object is its pivot (import_mdr applies the inverse transform to the vertices before it sets the
+transform as matrix_world). So all object nodes have an identity transform, a child is placed the
+same with or without its parents and the same as in the merged export, and the MDR transform and
+inverse transform are kept in the node extras.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+GLB_MAGIC = 0x46546C67  # "glTF"
+GLB_VERSION = 2
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+# accessor component types
+GL_UNSIGNED_SHORT = 5123
+GL_UNSIGNED_INT = 5125
+GL_FLOAT = 5126
+# buffer view targets
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+# primitive modes
+GL_TRIANGLES = 4
+
+_ACCESSOR_TYPES = {1: "SCALAR", 2: "VEC2", 3: "VEC3", 4: "VEC4"}
+_COMPONENT_TYPES = {np.dtype("<u2"): GL_UNSIGNED_SHORT, np.dtype("<u4"): GL_UNSIGNED_INT,
+                    np.dtype("<f4"): GL_FLOAT}
+
+
+def _padding(size):
+    return (4 - size % 4) % 4
+
+
+def column_major(matrix):
+    """glTF wants 4x4 matrices as 16 floats in column order."""
+    return np.asarray(matrix, dtype=np.float64).T.ravel().tolist()
+
+
+def gltf_uvs(uvs):
+    """MDR texture coordinates start at the bottom left like OpenGL, glTF at the top left."""
+    uvs = np.array(uvs, dtype="<f4").reshape(-1, 2)
+    uvs[:, 1] = 1.0 - uvs[:, 1]
+    return uvs
+
+
+def gltf_normals(normals):
+    """glTF normals are unit length float vectors, MDR stores them as i16 scaled by 32767.
+    A zero normal has no direction and becomes +z, glTF rejects anything that is not unit length."""
+    normals = np.asarray(normals, dtype="<f4").reshape(-1, 3) / np.float32(2**15 - 1)
+    length = np.sqrt((normals * normals).sum(axis=1, keepdims=True))
+    zero = length[:, 0] == 0
+    length[zero] = 1.0
+    normals = normals / length
+    normals[zero] = (0.0, 0.0, 1.0)
+    return normals
+
+
+class GLBBuilder:
+    """Collects the JSON document and the list of arrays that make up the binary chunk.
+    Arrays are kept as they are and written one after another, nothing is concatenated."""
+    def __init__(self):
+        self.gltf = {"asset": {"version": "2.0", "generator": "CM2Tools unmdr"},
+                     "scene": 0, "scenes": [{"nodes": []}], "nodes": [], "meshes": [], "materials": [],
+                     "accessors": [], "bufferViews": [], "buffers": [{"byteLength": 0}]}
+        self.blobs = []
+        self.size = 0
+
+    def add_view(self, array, target):
+        """Append array to the binary chunk and return the index of its buffer view."""
+        array = np.ascontiguousarray(array)
+        view = {"buffer": 0, "byteOffset": self.size, "byteLength": array.nbytes, "target": target}
+        self.blobs.append(array)
+        self.size += array.nbytes
+        pad = _padding(array.nbytes)
+        if pad:
+            self.blobs.append(b"\0" * pad)
+            self.size += pad
+        self.gltf["bufferViews"].append(view)
+        return len(self.gltf["bufferViews"]) - 1
+
+    def add_accessor(self, array, width, target, bounds=False):
+        array = np.asarray(array).reshape(-1, width)
+        accessor = {"bufferView": self.add_view(array, target), "componentType": _COMPONENT_TYPES[array.dtype],
+                    "count": array.size if target == GL_ELEMENT_ARRAY_BUFFER else len(array),
+                    "type": "SCALAR" if target == GL_ELEMENT_ARRAY_BUFFER else _ACCESSOR_TYPES[width]}
+        if bounds:
+            accessor["min"] = array.min(axis=0).tolist()
+            accessor["max"] = array.max(axis=0).tolist()
+        self.gltf["accessors"].append(accessor)
+        return len(self.gltf["accessors"]) - 1
+
+    def add_material(self, ob):
+        material = {"name": ob.texture_name or ob.name, "doubleSided": False,
+                    "pbrMetallicRoughness": {"metallicFactor": 0.0, "roughnessFactor": 1.0},
+                    "extras": {"texture": "%s.bmp" % ob.texture_name}}
+        if "diffuse_color" in ob.material:
+            color = list(ob.material["diffuse_color"]) + [ob.material.get("alpha_constant", 1.0)]
+            material["pbrMetallicRoughness"]["baseColorFactor"] = [min(max(float(c), 0.0), 1.0) for c in color]
+            material["extras"].update({key: value for key, value in ob.material.items()})
+        self.gltf["materials"].append(material)
+        return len(self.gltf["materials"]) - 1
+
+    def add_primitive(self, ob):
+        """Add the geometry of ob as a primitive, returns None for an object without vertices."""
+        vertices = np.asarray(ob.vertex_array, dtype="<f4").reshape(-1, 3)
+        if len(vertices) == 0:
+            return None
+        normals = None
+        if len(ob.vertex_normal_array) == len(vertices):
+            normals = gltf_normals(ob.vertex_normal_array)
+        attributes = {"POSITION": self.add_accessor(vertices, 3, GL_ARRAY_BUFFER, bounds=True)}
+        if normals is not None:
+            attributes["NORMAL"] = self.add_accessor(normals, 3, GL_ARRAY_BUFFER)
+        if len(ob.uv_array) == len(vertices):
+            attributes["TEXCOORD_0"] = self.add_accessor(gltf_uvs(ob.uv_array), 2, GL_ARRAY_BUFFER)
+        primitive = {"attributes": attributes, "mode": GL_TRIANGLES, "material": self.add_material(ob)}
+        indices = np.asarray(ob.index_array)
+        if indices.size != 0:
+            if indices.dtype not in (np.dtype("<u2"), np.dtype("<u4")):
+                indices = indices.astype("<u4")
+            primitive["indices"] = self.add_accessor(indices, 3, GL_ELEMENT_ARRAY_BUFFER)
+        return primitive
+
+    def add_mesh(self, ob):
+        """Add the geometry of ob as a mesh, return its index or None for an object without vertices."""
+        primitive = self.add_primitive(ob)
+        if primitive is None:
+            return None
+        self.gltf["meshes"].append({"name": ob.name, "primitives": [primitive]})
+        return len(self.gltf["meshes"]) - 1
+
+    def add_model(self, mdr):
+        """Add all objects of mdr as nodes, children follow parent_name and anchors hang below their object."""
+        nodes = self.gltf["nodes"]
+        first = len(nodes)
+        by_name = {}
+        for ob in mdr.objects:
+            node = {"name": ob.name, "extras": {}}
+            if ob.transform_matrix is not None:
+                node["extras"]["transform_matrix"] = column_major(ob.transform_matrix)
+            if ob.inverse_transform_matrix is not None:
+                node["extras"]["inverse_transform_matrix"] = column_major(ob.inverse_transform_matrix)
+            mesh = self.add_mesh(ob)
+            if mesh is not None:
+                node["mesh"] = mesh
+            by_name.setdefault(ob.name, len(nodes))
+            nodes.append(node)
+        parents = {}
+        for i, ob in enumerate(mdr.objects):
+            parent = by_name.get(ob.parent_name) if ob.parent_name else None
+            # glTF nodes have to form trees, an object that ends up as its own ancestor becomes a root
+            ancestor = parent
+            while ancestor is not None and ancestor != first + i:
+                ancestor = parents.get(ancestor)
+            parents[first + i] = None if ancestor is not None else parent
+        for i, ob in enumerate(mdr.objects):
+            node = nodes[first + i]
+            parent = parents[first + i]
+            if parent is None:
+                self.gltf["scenes"][0]["nodes"].append(first + i)
+            else:
+                nodes[parent].setdefault("children", []).append(first + i)
+            for anchor_name, matrix in ob.anchor_points:
+                node.setdefault("children", []).append(len(nodes))
+                nodes.append({"name": anchor_name, "matrix": column_major(matrix), "extras": {"anchor": True}})
+
+    def add_merged_model(self, mdr):
+        """Add all objects of mdr as one node with one mesh, a primitive per object.
+        Anchors are children of the node."""
+        primitives = []
+        anchors = []
+        for ob in mdr.objects:
+            primitive = self.add_primitive(ob)
+            if primitive is not None:
+                primitive.setdefault("extras", {})["name"] = ob.name
+                primitives.append(primitive)
+            for anchor_name, anchor in ob.anchor_points:
+                anchors.append({"name": anchor_name, "matrix": column_major(anchor),
+                                "extras": {"anchor": True, "object": ob.name}})
+        nodes = self.gltf["nodes"]
+        node = {"name": mdr.base_name}
+        if primitives:
+            self.gltf["meshes"].append({"name": mdr.base_name, "primitives": primitives})
+            node["mesh"] = len(self.gltf["meshes"]) - 1
+        self.gltf["scenes"][0]["nodes"].append(len(nodes))
+        nodes.append(node)
+        if anchors:
+            node["children"] = list(range(len(nodes), len(nodes) + len(anchors)))
+            nodes.extend(anchors)
+
+    def write(self, f):
+        """Write the .glb to the binary file f and return the number of bytes written."""
+        self.gltf["buffers"][0]["byteLength"] = self.size
+        if self.size == 0:
+            del self.gltf["buffers"]
+        # glTF does not allow empty top level arrays
+        gltf = {key: value for key, value in self.gltf.items() if value != []}
+        document = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+        document += b" " * _padding(len(document))
+        total = 12 + 8 + len(document) + (8 + self.size if self.size else 0)
+        f.write(struct.pack("<III", GLB_MAGIC, GLB_VERSION, total))
+        f.write(struct.pack("<II", len(document), CHUNK_JSON))
+        f.write(document)
+        if self.size:
+            f.write(struct.pack("<II", self.size, CHUNK_BIN))
+            for blob in self.blobs:
+                f.write(blob if isinstance(blob, bytes) else memoryview(blob).cast("B"))
+        return total
+
+
+def write_glb(mdr, f, merge=False):
+    """Write all objects of a parsed MDR as one binary glTF to the binary file f, return the bytes written.
+    With merge the objects are one mesh instead of a node hierarchy, see GLBBuilder.add_merged_model."""
+    builder = GLBBuilder()
+    if merge:
+        builder.add_merged_model(mdr)
+    else:
+        builder.add_model(mdr)
+    return builder.write(f)
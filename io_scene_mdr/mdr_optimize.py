@@ -0,0 +1,159 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Script copyright (C) Stanislav Bobovych
+# Contributors: Stanislav Bobovych
+
+"""
+Post-transform vertex cache optimization of MDR meshes.
+
+Faces are reordered with Tipsify (Sander, Nehab and Barczak, "Fast Triangle Reordering for Vertex
+Locality and Reduced Overdraw", 2007) so consecutive faces share vertices, then vertices are
+renumbered in the order the faces first use them so vertex fetches walk the arrays front to back.
+The quality measure is the ACMR, the average number of vertices transformed per face with a FIFO
+cache of a given size: 3.0 is no reuse at all, a regular grid approaches 0.5.
+"""
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 16
+
+
+def acmr(indices, cache_size=DEFAULT_CACHE_SIZE):
+    """Average cache miss ratio of the (n, 3) face indices with a FIFO cache of cache_size vertices."""
+    flat = np.asarray(indices).ravel().tolist()
+    if not flat:
+        return 0.0
+    # a vertex stays cached until cache_size other vertices were loaded after it
+    stamps = {}
+    misses = 0
+    for v in flat:
+        stamp = stamps.get(v)
+        if stamp is None or misses - stamp > cache_size:
+            stamps[v] = misses
+            misses += 1
+    return misses / (len(flat) // 3)
+
+
+def tipsify(indices, vertex_count, cache_size=DEFAULT_CACHE_SIZE):
+    """Return the order in which to emit the (n, 3) faces for cache_size vertex cache reuse.
+    Faces are fanned around one vertex at a time, the next fanning vertex is the one of the last
+    emitted faces that is still cached and has the fewest faces left, a dead end falls back to
+    recently used vertices and then to the lowest vertex that still has faces."""
+    faces = np.asarray(indices).reshape(-1, 3)
+    flat = faces.ravel().astype(np.int64)
+    counts = np.bincount(flat, minlength=vertex_count)
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    adjacency = (np.argsort(flat, kind="stable") // 3).tolist()  # faces of vertex v: offsets[v]:offsets[v + 1]
+    offsets = offsets.tolist()
+    live = counts.tolist()  # faces not yet emitted per vertex
+    face_list = faces.tolist()
+    stamps = [0] * vertex_count
+    emitted = bytearray(len(faces))
+    dead_end = []
+    order = []
+    time = cache_size + 1
+    cursor = 0
+    fan = 0
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = 1
+            order.append(t)
+            for v in face_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - stamps[v] > cache_size:
+                    stamps[v] = time
+                    time += 1
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                age = time - stamps[v]
+                priority = age if age + 2 * live[v] <= cache_size else 0
+                if priority > best:
+                    best = priority
+                    fan = v
+        if fan < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan = v
+                    break
+        if fan < 0:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                    break
+                cursor += 1
+    return np.array(order, dtype=np.int64)
+
+
+def vertex_order(indices, vertex_count):
+    """Return the old vertex number of every new vertex: vertices in the order the faces first use
+    them, followed by those no face uses in their old order."""
+    flat = np.asarray(indices).ravel()
+    used, first = np.unique(flat, return_index=True)
+    order = used[np.argsort(first, kind="stable")]
+    if len(order) < vertex_count:
+        unused = np.ones(vertex_count, dtype=bool)
+        unused[order] = False
+        order = np.concatenate((order, np.flatnonzero(unused)))
+    return order.astype(np.int64)
+
+
+def optimize_object(ob, cache_size=DEFAULT_CACHE_SIZE):
+    """Reorder the faces and vertices of an MDRObject in place, uvs and normals follow their vertices.
+    The face order is only kept when it lowers the ACMR. Vertices are only renumbered when the uv and
+    normal arrays are empty or have one row per vertex, consumers index all three with the same number.
+    Returns the ACMR before and after."""
+    indices = np.asarray(ob.index_array).reshape(-1, 3)
+    vertex_count = len(ob.vertex_array)
+    before = acmr(indices, cache_size)
+    if indices.size == 0 or int(indices.max()) >= vertex_count:
+        return before, before
+    faces = indices[tipsify(indices, vertex_count, cache_size)]
+    after = acmr(faces, cache_size)
+    if after >= before:
+        faces = indices
+        after = before
+    if any(len(array) not in (0, vertex_count) for array in (ob.uv_array, ob.vertex_normal_array)):
+        ob.index_array = faces
+        return before, after
+    order = vertex_order(faces, vertex_count)
+    remap = np.empty(vertex_count, dtype=np.int64)
+    remap[order] = np.arange(vertex_count)
+    ob.index_array = remap[faces]
+    if len(ob.uv_array) != 0:
+        ob.uv_array = np.asarray(ob.uv_array)[order]
+    if len(ob.vertex_normal_array) != 0:
+        ob.vertex_normal_array = np.asarray(ob.vertex_normal_array)[order]
+    ob.vertex_array = np.asarray(ob.vertex_array)[order]
+    return before, after
+
+
+def optimize_model(mdr, cache_size=DEFAULT_CACHE_SIZE):
+    """Optimize every object of an MDR, return a list of (name, acmr before, acmr after)."""
+    return [(ob.name,) + optimize_object(ob, cache_size) for ob in mdr.objects]
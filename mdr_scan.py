@@ -0,0 +1,184 @@
+"""@package mdr_scan
+Parse every mdr file of a Combat Mission install, or any set of files, directories
+and brz files, with a pool of workers and report statistics and anomalies.
+"""
+
+"""
+Copyright (C) 2026 Stanislav Bobovych
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import argparse
+import json
+import time
+from multiprocessing import Pool, cpu_count
+
+sys.path.append("io_scene_mdr") # doing this instead of import to avoid executing __init__.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "io_scene_mdr"))
+from mdr import MDR, Trace, TRACE_WARNING
+from brz_magick import BrzFile, find_archives, load_table
+
+
+def find_models(paths):
+    """ Return (path, entry) work items for every mdr under paths. entry is None for loose files and
+    the "dir/name" of the model for files inside a brz. Items of the same brz are kept together
+    and in offset order so a chunk of work reads one archive front to back."""
+    items = []
+    for path in paths:
+        if os.path.isfile(path) and not path.lower().endswith(".brz"):
+            items.append((path, None))
+            continue
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(".mdr"):
+                        items.append((os.path.join(dirpath, filename), None))
+        for archive in find_archives(path):
+            with open(archive, "rb") as f:
+                table = load_table(f)
+            indices = [i for i in range(0, len(table)) if table.names[i].lower().endswith(".mdr")]
+            indices.sort(key=table.offsets.__getitem__)
+            items.extend((archive, table.key(i)) for i in indices)
+    return items
+
+
+# archives opened by a scan worker, kept open for all the chunks it gets
+_worker_archives = {}
+
+
+def scan_model(item):
+    """ Parse one model and return a dict with its statistics, or the error that stopped the parser."""
+    path, entry = item
+    name = path if entry is None else "%s:%s" % (path, entry)
+    result = {"file": name, "ok": True, "error": None, "models": 0, "faces": 0, "vertices": 0, "bytes": 0,
+              "sections": {}, "warnings": []}
+    events = []
+    trace = Trace(TRACE_WARNING, None, None, events)
+    data = None
+    try:
+        base_name = os.path.splitext(os.path.basename(entry if entry is not None else path))[0]
+        m = MDR(name, base_name, trace=trace)
+        if entry is None:
+            result["bytes"] = os.path.getsize(path)
+            m.read("", lazy=True)
+        else:
+            brz = _worker_archives.get(path)
+            if brz is None:
+                brz = BrzFile(path).open()
+                _worker_archives[path] = brz
+            data = brz.read_entry(entry)
+            result["bytes"] = len(data)
+            m.read("", data, lazy=True)
+        result["models"] = m.num_models
+        for ob in m.objects:
+            result["faces"] += ob.count("indices")
+            result["vertices"] += ob.count("vertices")
+            for section, (offset, length) in ob.sections.items():
+                if section != "model":
+                    result["sections"][section] = result["sections"].get(section, 0) + length
+        del m
+    except Exception as err:
+        result["ok"] = False
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    finally:
+        if data is not None:
+            data.release()
+    result["warnings"] = [e["message"] for e in events if e["event"] == "warning"]
+    return result
+
+
+def scan(items, workers=None, progress=None):
+    """ Parse all work items with a process pool and return the list of per file results.
+    Items are handed out in chunks so workers are not starved and inter-process traffic stays low."""
+    if workers is None:
+        workers = cpu_count()
+    results = []
+    if workers <= 1:
+        for item in items:
+            results.append(scan_model(item))
+            if progress is not None:
+                progress(len(results), len(items))
+        return results
+    chunksize = max(1, min(64, len(items) // (workers * 8)))
+    pool = Pool(workers)
+    try:
+        for result in pool.imap_unordered(scan_model, items, chunksize):
+            results.append(result)
+            if progress is not None:
+                progress(len(results), len(items))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def summarize(results, elapsed):
+    summary = {"files": len(results), "failed": 0, "with_warnings": 0, "models": 0, "faces": 0, "vertices": 0,
+               "bytes": 0, "sections": {}, "warnings": {}, "seconds": elapsed,
+               "files_per_second": len(results) / elapsed if elapsed > 0 else 0.0}
+    for result in results:
+        if not result["ok"]:
+            summary["failed"] += 1
+        if len(result["warnings"]) != 0:
+            summary["with_warnings"] += 1
+        for warning in result["warnings"]:
+            summary["warnings"][warning] = summary["warnings"].get(warning, 0) + 1
+        for key in ("models", "faces", "vertices", "bytes"):
+            summary[key] += result[key]
+        for section, length in result["sections"].items():
+            summary["sections"][section] = summary["sections"].get(section, 0) + length
+    return summary
+
+
+def print_summary(summary, results):
+    for result in sorted(results, key=lambda r: r["file"]):
+        if not result["ok"]:
+            print("FAILED %s: %s" % (result["file"], result["error"]))
+    print("Files: %i, failed: %i, with warnings: %i" % (summary["files"], summary["failed"], summary["with_warnings"]))
+    print("Models: %i, faces: %i, vertices: %i, bytes: %i" % (summary["models"], summary["faces"], summary["vertices"],
+                                                              summary["bytes"]))
+    print("Section bytes:")
+    for section, length in sorted(summary["sections"].items(), key=lambda s: -s[1]):
+        print("    %s: %i" % (section, length))
+    if len(summary["warnings"]) != 0:
+        print("Warnings:")
+        for warning, count in sorted(summary["warnings"].items(), key=lambda w: -w[1]):
+            print("    %i x %s" % (count, warning))
+    print("Time: %.2f s, %.1f files/s" % (summary["seconds"], summary["files_per_second"]))
+
+
+def print_progress(done, total):
+    if done % 100 == 0 or done == total:
+        sys.stdout.write('\r%i/%i\r' % (done, total))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parse all mdr files in files, directories and brz files and report statistics.')
+    parser.add_argument('paths', nargs='+', help='mdr files, directories or brz files')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes, defaults to the number of cores')
+    parser.add_argument('--json', default=None, help='Write the summary and per file results to this JSON file')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    items = find_models(args.paths)
+    results = scan(items, args.jobs, print_progress)
+    t1 = time.time()
+    print("")
+    summary = summarize(results, t1 - t0)
+    print_summary(summary, results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"summary": summary, "files": sorted(results, key=lambda r: r["file"])}, f, indent=1)
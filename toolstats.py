@@ -0,0 +1,180 @@
+"""@package toolstats
+Per stage timing and memory statistics shared by the command line tools.
+"""
+
+"""
+Copyright (C) 2026 Stanislav Bobovych
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss(who=None):
+    """ Peak resident set size in bytes of this process, or of its finished children, None where unknown."""
+    if resource is None:
+        return None
+    if who is None:
+        who = resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+class Stage:
+    """ Totals of one named stage, a stage can be entered many times, e.g. once per file."""
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.tracemalloc_peak = None
+        self.t0 = None
+
+    def add(self, bytes_read=0, bytes_written=0):
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def __enter__(self):
+        if self.stats.tracemalloc:
+            self.stats.fold_peak()
+            tracemalloc.reset_peak()
+            self.stats.open_stages.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.perf_counter() - self.t0
+        self.calls += 1
+        if self.stats.tracemalloc:
+            self.stats.fold_peak()
+            self.stats.open_stages.remove(self)
+
+    def report(self):
+        total = self.bytes_read + self.bytes_written
+        result = {"calls": self.calls, "seconds": self.seconds, "bytes_read": self.bytes_read,
+                  "bytes_written": self.bytes_written,
+                  "mb_per_s": total / self.seconds / 1e6 if self.seconds > 0 else None}
+        if self.tracemalloc_peak is not None:
+            result["tracemalloc_peak"] = self.tracemalloc_peak
+        return result
+
+
+class NullStage:
+    """ Stage used while statistics are off, it does nothing."""
+    def add(self, bytes_read=0, bytes_written=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Stats:
+    """ Collects wall time, bytes read and written and memory per stage.
+    Stages are timed inclusively, an outer stage also counts the time of the stages inside it."""
+    def __init__(self, enabled=False, out=None, use_tracemalloc=False, profile=None):
+        self.enabled = enabled
+        self.out = out
+        self.tracemalloc = enabled and use_tracemalloc
+        self.profile = profile
+        self.profiler = None
+        self.stages = {}
+        self.open_stages = []
+        self.t0 = None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.stats is not None, args.stats, args.stats_tracemalloc, args.profile)
+
+    def stage(self, name):
+        """ Context manager timing one pass through the stage name, use its add() to count bytes."""
+        if not self.enabled:
+            return NULL_STAGE
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(self, name)
+        return stage
+
+    def fold_peak(self):
+        """ Credit the tracemalloc peak since the last reset to every stage that is open,
+        so an outer stage keeps its peak when an inner stage resets the counter."""
+        size, peak = tracemalloc.get_traced_memory()
+        for stage in self.open_stages:
+            stage.tracemalloc_peak = max(peak, stage.tracemalloc_peak or 0)
+
+    def start(self):
+        self.t0 = time.perf_counter()
+        if self.tracemalloc:
+            tracemalloc.start()
+        if self.profile is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def report(self):
+        return {"command": sys.argv, "seconds": time.perf_counter() - self.t0, "peak_rss": peak_rss(),
+                "peak_rss_children": peak_rss(resource.RUSAGE_CHILDREN) if resource is not None else None,
+                "stages": {name: stage.report() for name, stage in self.stages.items()}}
+
+    def finish(self):
+        """ Stop profiling and write the JSON report to out, "-" is stderr so it stays apart from the tool's output."""
+        if self.t0 is None:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+        if self.out is not None:
+            report = self.report()
+            if self.out == "-":
+                print(json.dumps(report, indent=1), file=sys.stderr)
+            else:
+                with open(self.out, "w") as f:
+                    json.dump(report, f, indent=1)
+        if self.tracemalloc:
+            tracemalloc.stop()
+        self.t0 = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+
+NO_STATS = Stats()
+
+
+def add_arguments(parser):
+    """ Add the --stats, --stats-tracemalloc and --profile options shared by the tools."""
+    parser.add_argument('--stats', default=None, metavar='FILE',
+                        help='Write wall time, bytes read and written, throughput and peak memory of every stage as JSON to this file, - for stderr')
+    parser.add_argument('--stats-tracemalloc', default=False, action='store_true',
+                        help='Also record the peak Python allocation of every stage, slows the tools down')
+    parser.add_argument('--profile', default=None, help='Write a cProfile dump to this file, read it with python -m pstats')
@@ -21,10 +21,22 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import argparse
+import fnmatch
+import io
+import time
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
 
 
 sys.path.append("io_scene_mdr") # doing this instead of import to avoid executing __init__.py
-from mdr import MDR
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "io_scene_mdr"))
+from mdr import MDR, Trace, TRACE_QUIET, TRACE_WARNING, TRACE_SECTION, TRACE_DETAIL
+from mdr_cache import MDRCache, default_cache_dir, DEFAULT_MAX_BYTES
+from mdr_gltf import write_glb
+from brz_magick import BrzFile, make_dirs
+from mdr_scan import find_models
+from toolstats import NO_STATS, Stats, add_arguments as add_stats_arguments
 
 def float2string(f):
     return "{0:.12f}".format(f)
@@ -32,42 +44,114 @@ def float2string(f):
 def short2float(value):
     return value / (2.0**15 - 1)
 
-def make_wavefront_obj(mdr_ob):
-    """ Serialize mdr to obj format and return it as a string."""
-    string = ""
-    string += "o %s\n" % mdr_ob.name
-    # write material info
-    string += "mtllib %s\n" % mdr_ob.name
-    string += "usemtl %s\n" % mdr_ob.name
+OBJ_CHUNK_ROWS = 8192
+
+
+def obj_lines(f, template, array, width, convert=None, chunk_rows=OBJ_CHUNK_ROWS):
+    """ Write one line per row of array formatted with template, chunk_rows rows at a time.
+    convert, if given, maps a chunk of rows to the values the template takes. Each chunk is a
+    single % over the flattened rows, so the cost is linear and the memory bounded by the chunk
+    size. Returns the number of bytes written."""
+    array = np.asarray(array).reshape(-1, width)
+    written = 0
+    for start in range(0, len(array), chunk_rows):
+        chunk = array[start:start + chunk_rows]
+        if convert is not None:
+            chunk = convert(chunk)
+        data = ((template * len(chunk)) % tuple(chunk.ravel().tolist())).encode("ascii")
+        f.write(data)
+        written += len(data)
+    return written
+
+
+_normal_strings = None
+
+
+def normal_strings(normals):
+    """ str() of every normal component as i16 / 32767. There are only 65536 distinct values, so
+    large models look them up in a table built on first use instead of formatting every float."""
+    global _normal_strings
+    normals = normals.astype(np.int64)
+    if _normal_strings is None and normals.size < 8192:
+        return normals / (2.0**15 - 1)
+    if _normal_strings is None:
+        _normal_strings = np.array([str(short2float(i)) for i in range(-32768, 32768)])
+    return _normal_strings[normals + 32768]
+
+
+def face_numbers(repeat):
+    """ Convert rows of vertex indices to 1 based obj numbers, each repeated for v/vt(/vn)."""
+    def convert(faces):
+        return np.repeat(faces.astype(np.int64) + 1, repeat, axis=1)
+    return convert
+
+
+def write_wavefront_obj(mdr_ob, f, chunk_rows=OBJ_CHUNK_ROWS):
+    """ Stream mdr in obj format to the binary file f and return the number of bytes written.
+    "vt" and "vn" values are printed like str(float), "v" values with 12 decimals."""
+    header = ("o %s\n" % mdr_ob.name +
+              # write material info
+              "mtllib %s\n" % mdr_ob.name +
+              "usemtl %s\n" % mdr_ob.name).encode("ascii")
+    f.write(header)
+    written = len(header)
 
     use_Blender_order = True
     # write vertex info
     if use_Blender_order:
-        for vert in mdr_ob.vertex_array:
-            string += "v %s %s %s\n" % ( float2string(vert[0]), float2string(vert[1]), float2string(vert[2]))
-        for uv in mdr_ob.uv_array:
-            string += "vt %s %s\n" % (uv[0], uv[1])
-        for norm in mdr_ob.vertex_normal_array:
-            string += "vn %s %s %s\n" % (short2float(norm[0]), short2float(norm[1]), short2float(norm[2]))
-        for idx in mdr_ob.index_array:
-            # string += "f %i/%i/%i %i/%i/%i %i/%i/%i\n" % (
-            # idx[0] + 1, idx[0] + 1, idx[0] + 1, idx[1] + 1, idx[1] + 1, idx[1] + 1, idx[2] + 1, idx[2] + 1,
-            # idx[2] + 1)
-            string += "f %i/%i %i/%i %i/%i\n" % (
-            idx[0] + 1, idx[0] + 1, idx[1] + 1, idx[1] + 1, idx[2] + 1, idx[2] + 1)
+        written += obj_lines(f, "v %.12f %.12f %.12f\n", mdr_ob.vertex_array, 3, None, chunk_rows)
+        written += obj_lines(f, "vt %s %s\n", mdr_ob.uv_array, 2, None, chunk_rows)
+        written += obj_lines(f, "vn %s %s %s\n", mdr_ob.vertex_normal_array, 3, normal_strings, chunk_rows)
+        # written += obj_lines(f, "f %i/%i/%i %i/%i/%i %i/%i/%i\n", mdr_ob.index_array, 3, face_numbers(3), chunk_rows)
+        written += obj_lines(f, "f %i/%i %i/%i %i/%i\n", mdr_ob.index_array, 3, face_numbers(2), chunk_rows)
     else:
-        for idx in mdr_ob.index_array:
-            string += "f %i/%i/%i %i/%i/%i %i/%i/%i\n" % (
-            idx[0] + 1, idx[0] + 1, idx[0] + 1, idx[1] + 1, idx[1] + 1, idx[1] + 1, idx[2] + 1, idx[2] + 1,
-            idx[2] + 1)
-        for uv in mdr_ob.uv_array:
-            string += "vt %s %s\n" % (uv[0], uv[1])
-        for vert in mdr_ob.vertex_array:
-            string += "v %s %s %s\n" % ( float2string(vert[0]), float2string(vert[1]), float2string(vert[2]))
-        for norm in mdr_ob.vertex_normal_array:
-            string += "vn %s %s %s\n" % (short2float(norm[0]), short2float(norm[1]), short2float(norm[2]))
+        written += obj_lines(f, "f %i/%i/%i %i/%i/%i %i/%i/%i\n", mdr_ob.index_array, 3, face_numbers(3), chunk_rows)
+        written += obj_lines(f, "vt %s %s\n", mdr_ob.uv_array, 2, None, chunk_rows)
+        written += obj_lines(f, "v %.12f %.12f %.12f\n", mdr_ob.vertex_array, 3, None, chunk_rows)
+        written += obj_lines(f, "vn %s %s %s\n", mdr_ob.vertex_normal_array, 3, normal_strings, chunk_rows)
+    return written
 
-    return string
+
+def merged_face_numbers(v_offset, vt_offset):
+    """ Convert rows of vertex indices to 1 based v/vt numbers of an object whose vertices and uvs
+    start at v_offset and vt_offset in a merged obj."""
+    def convert(faces):
+        faces = faces.astype(np.int64) + 1
+        numbers = np.empty((len(faces), 6), dtype=np.int64)
+        numbers[:, 0::2] = faces + v_offset
+        numbers[:, 1::2] = faces + vt_offset
+        return numbers
+    return convert
+
+
+def write_merged_obj(m, f, mtl_name, chunk_rows=OBJ_CHUNK_ROWS):
+    """ Stream all objects of m into one obj, an "o" group with its own material per object.
+    Vertices are stored in model space, so the groups line up without applying any transform.
+    Returns the number of bytes written."""
+    header = ("mtllib %s\n" % mtl_name).encode("ascii")
+    f.write(header)
+    written = len(header)
+    v_offset = 0
+    vt_offset = 0
+    for ob in m.objects:
+        head = ("o %s\nusemtl %s\n" % (ob.name, ob.name)).encode("ascii")
+        f.write(head)
+        written += len(head)
+        written += obj_lines(f, "v %.12f %.12f %.12f\n", ob.vertex_array, 3, None, chunk_rows)
+        written += obj_lines(f, "vt %s %s\n", ob.uv_array, 2, None, chunk_rows)
+        written += obj_lines(f, "vn %s %s %s\n", ob.vertex_normal_array, 3, normal_strings, chunk_rows)
+        written += obj_lines(f, "f %i/%i %i/%i %i/%i\n", ob.index_array, 3, merged_face_numbers(v_offset, vt_offset),
+                             chunk_rows)
+        v_offset += len(ob.vertex_array)
+        vt_offset += len(ob.uv_array)
+    return written
+
+
+def make_wavefront_obj(mdr_ob):
+    """ Serialize mdr to obj format and return it as a string."""
+    f = io.BytesIO()
+    write_wavefront_obj(mdr_ob, f)
+    return f.getvalue().decode("ascii")
 
 
 def make_wavefront_mtl(mdr_ob):
@@ -89,31 +173,296 @@ def make_wavefront_mtl(mdr_ob):
     string += "map_Kd %s.bmp\n" % mdr_ob.texture_name
     return string
 
+def write_model(m, outdir, stats=NO_STATS, fmt="obj", merge=False):
+    """ Write every object of m to outdir as <model>_<object>.obj and .mtl, or with fmt "glb" the
+    whole model with its hierarchy and anchor points as <model>.glb. With merge all objects go into
+    one <model>.obj and <model>.mtl, or one mesh in the glb. Returns the number of bytes written."""
+    if fmt == "glb":
+        with stats.stage("serialize") as stage, open(os.path.join(outdir, "%s.glb" % m.base_name), 'wb') as glb_fout:
+            written = write_glb(m, glb_fout, merge)
+            stage.add(bytes_written=written)
+        return written
+    if merge:
+        mtl_name = "%s.mtl" % m.base_name
+        with stats.stage("serialize") as stage, open(os.path.join(outdir, "%s.obj" % m.base_name), 'wb') as obj_fout:
+            written = write_merged_obj(m, obj_fout, mtl_name)
+            stage.add(bytes_written=written)
+        with stats.stage("serialize") as stage:
+            mtl = "".join(make_wavefront_mtl(ob) for ob in m.objects).encode("ascii")
+            stage.add(bytes_written=len(mtl))
+        with stats.stage("write") as stage, open(os.path.join(outdir, mtl_name), 'wb') as mtl_fout:
+            mtl_fout.write(mtl)
+            stage.add(bytes_written=len(mtl))
+        return written + len(mtl)
+    written = 0
+    for ob in m.objects:
+        # the obj is formatted and written in chunks, so this stage includes its file write
+        with stats.stage("serialize") as stage, \
+                open(os.path.join(outdir, "%s_%s.obj" % (ob.base_name, ob.name)), 'wb') as obj_fout:
+            size = write_wavefront_obj(ob, obj_fout)
+            stage.add(bytes_written=size)
+        with stats.stage("serialize") as stage:
+            mtl = make_wavefront_mtl(ob).encode("ascii")
+            stage.add(bytes_written=len(mtl))
+        with stats.stage("write") as stage, \
+                open(os.path.join(outdir, "%s_%s.mtl" % (ob.base_name, ob.name)), 'wb') as mtl_fout:
+            mtl_fout.write(mtl)
+            stage.add(bytes_written=len(mtl))
+        written += size + len(mtl)
+    return written
+
+
+def batch_tasks(inputs, outdir):
+    """ Expand mdr files, directories and brz files into (path, entry, output directory) tasks.
+    Models found in a directory keep their path below it and models in a brz go below a directory
+    named after the archive, so output names do not depend on which worker converts what."""
+    tasks = []
+    for path in inputs:
+        if os.path.isfile(path) and not path.lower().endswith(".brz"):
+            tasks.append((path, None, outdir))
+            continue
+        for model, entry in find_models([path]):
+            if entry is None:
+                target = os.path.join(outdir, os.path.relpath(os.path.dirname(model), path))
+            else:
+                archive = os.path.relpath(model, path) if os.path.isdir(path) else os.path.basename(model)
+                target = os.path.join(outdir, os.path.splitext(archive)[0], os.path.dirname(entry))
+            tasks.append((model, entry, os.path.normpath(target)))
+    return tasks
+
+
+def output_collisions(tasks):
+    """ Return {output name: [inputs]} for the models that would be written to the same output name,
+    e.g. a/package1.mdr and b/package1.mdr given side by side. Converting them would overwrite each other."""
+    inputs = {}
+    for path, entry, outdir in tasks:
+        base_name = os.path.splitext(os.path.basename(entry if entry is not None else path))[0]
+        key = os.path.normcase(os.path.join(outdir, base_name))
+        inputs.setdefault(key, []).append(path if entry is None else "%s:%s" % (path, entry))
+    return {key: names for key, names in inputs.items() if len(names) > 1}
+
+
+# set in every batch worker by init_batch_worker
+_batch_parse_only = False
+_batch_cache = None
+_batch_output = ("obj", False)
+_batch_archives = {}
+
+
+def init_batch_worker(parse_only, cache, output=("obj", False)):
+    """ output is the (fmt, merge) arguments of write_model."""
+    global _batch_parse_only, _batch_cache, _batch_output
+    _batch_parse_only = parse_only
+    _batch_cache = cache
+    _batch_output = output
+
+
+def convert_task(task):
+    """ Convert one model and return a dict with what was done, or the error that stopped it."""
+    path, entry, outdir = task
+    name = path if entry is None else "%s:%s" % (path, entry)
+    result = {"file": name, "ok": True, "error": None, "objects": 0, "bytes_read": 0, "bytes_written": 0,
+              "warnings": []}
+    events = []
+    data = None
+    try:
+        base_name = os.path.splitext(os.path.basename(entry if entry is not None else path))[0]
+        m = MDR(name, base_name, _batch_parse_only, _batch_parse_only, False, Trace(TRACE_WARNING, None, None, events))
+        if entry is None:
+            result["bytes_read"] = os.path.getsize(path)
+        else:
+            brz = _batch_archives.get(path)
+            if brz is None:
+                brz = BrzFile(path).open()
+                _batch_archives[path] = brz
+            data = brz.read_entry(entry)
+            result["bytes_read"] = len(data)
+        if _batch_cache is not None:
+            _batch_cache.read(m, outdir, data)
+        else:
+            m.read(outdir, data)
+        result["objects"] = len(m.objects)
+        if not _batch_parse_only:
+            make_dirs(outdir)
+            result["bytes_written"] = write_model(m, outdir, NO_STATS, *_batch_output)
+        del m
+    except Exception as err:
+        result["ok"] = False
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    finally:
+        if data is not None:
+            data.release()
+    result["warnings"] = [e["message"] for e in events if e["event"] == "warning"]
+    return result
+
+
+def convert_batch(tasks, workers=None, parse_only=False, cache=None, progress=None, output=("obj", False)):
+    """ Convert all tasks with a process pool and return the per file results sorted by file."""
+    if workers is None:
+        workers = cpu_count()
+    results = []
+    if workers <= 1:
+        init_batch_worker(parse_only, cache, output)
+        for task in tasks:
+            results.append(convert_task(task))
+            if progress is not None:
+                progress(len(results), len(tasks))
+    else:
+        chunksize = max(1, min(16, len(tasks) // (workers * 8)))
+        pool = Pool(workers, init_batch_worker, (parse_only, cache, output))
+        try:
+            for result in pool.imap_unordered(convert_task, tasks, chunksize):
+                results.append(result)
+                if progress is not None:
+                    progress(len(results), len(tasks))
+        finally:
+            pool.close()
+            pool.join()
+    results.sort(key=lambda r: r["file"])
+    return results
+
+
+def print_batch_summary(results, elapsed):
+    failed = 0
+    for result in results:
+        for warning in result["warnings"]:
+            print("%s: %s" % (result["file"], warning))
+        if not result["ok"]:
+            failed += 1
+            print("FAILED %s: %s" % (result["file"], result["error"]))
+    print("Files: %i, failed: %i, objects: %i, read: %i bytes, written: %i bytes" % (
+        len(results), failed, sum(r["objects"] for r in results), sum(r["bytes_read"] for r in results),
+        sum(r["bytes_written"] for r in results)))
+    print("Time: %.2f s, %.1f files/s" % (elapsed, len(results) / elapsed if elapsed > 0 else 0.0))
+
+
+def print_progress(done, total):
+    if done % 100 == 0 or done == total:
+        sys.stdout.write('\r%i/%i\r' % (done, total))
+        sys.stdout.flush()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Tool for experimenting with mdr files.')
     parser.add_argument('-p', '--parse-only', default=False, action='store_true',
                         help='Only parse file, do not dump models')
     parser.add_argument('-v', '--verbose', default=False, action='store_true',
                         help='Print more info useful for debugging')
+    parser.add_argument('-s', '--summary', default=False, action='store_true',
+                        help='Only list submodels, parents and textures, geometry is not decoded')
+    parser.add_argument('-t', '--trace', default=None, choices=['quiet', 'warning', 'section', 'detail'],
+                        help='Parser trace level, section prints the offset and length of every section (default warning, detail with -v)')
+    parser.add_argument('--trace-json', default=None, help='Also write the parser trace to this file as JSON lines')
+    parser.add_argument('--cache', default=False, action='store_true',
+                        help='Keep parsed models in a cache and load them from there on the next run')
+    parser.add_argument('--cache-dir', default=None, metavar='DIR',
+                        help='Directory of the cache, implies --cache (default %s)' % default_cache_dir())
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='Size limit of the cache in MiB, least recently used models are removed first')
+    parser.add_argument('--cache-by-mtime', default=False, action='store_true',
+                        help='Key cached models by path, size and mtime instead of hashing the file')
     parser.add_argument('-o', '--outdir', default=os.getcwd(), help='Output path')
-    parser.add_argument('file', nargs='?', help='Input file')
+    parser.add_argument('-f', '--format', default='obj', choices=['obj', 'glb'],
+                        help='obj writes an OBJ and MTL per submodel, glb one binary glTF per model with hierarchy and anchor points')
+    parser.add_argument('-m', '--merge', default=False, action='store_true',
+                        help='Write all submodels of a model into one file instead of one file per submodel')
+    parser.add_argument('-b', '--brz', default=None,
+                        help='Read models straight from this brz file, file is then a "dir/name" glob inside it (default *.mdr), only .mdr entries match unless the glob names another extension')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Worker processes used when converting many files, defaults to the number of cores')
+    parser.add_argument('file', nargs='*',
+                        help='Input file. Several files, directories or brz files are converted in parallel, output keeps their directory structure')
+    add_stats_arguments(parser)
     args = parser.parse_args()
+    stats = Stats.from_args(args).start()
+
+    trace_level = TRACE_DETAIL if args.verbose else TRACE_WARNING
+    if args.trace is not None:
+        trace_level = {'quiet': TRACE_QUIET, 'warning': TRACE_WARNING, 'section': TRACE_SECTION, 'detail': TRACE_DETAIL}[args.trace]
+    trace_json = None
+    if args.trace_json is not None:
+        trace_json = open(args.trace_json, "w")
+    trace = Trace(trace_level, sys.stdout, trace_json)
+    cache = None
+    if (args.cache or args.cache_dir is not None) and not args.summary:
+        cache = MDRCache(args.cache_dir or default_cache_dir(), args.cache_size * 1024 * 1024, args.cache_by_mtime)
+
+    def read(m, data=None):
+        with stats.stage("decode") as stage:
+            if cache is not None:
+                cache.read(m, args.outdir, data)
+            else:
+                m.read(args.outdir, data, args.summary)
+            stage.add(bytes_read=len(data) if data is not None else os.path.getsize(m.filepath))
+
+    def dump(m):
+        if args.summary:
+            for ob in m.objects:
+                print("%s, parent %s, texture %s, %i faces, %i vertices, %i anchor points" % (
+                    ob.name, ob.parent_name or "-", ob.texture_name, ob.count("indices"), ob.count("vertices"),
+                    len(ob.anchor_points)))
+        elif not args.parse_only:
+            write_model(m, args.outdir, stats, args.format, args.merge)
+
+    if args.brz is not None:
+        pattern = "*.mdr" if len(args.file) == 0 else args.file[0]
+        pattern = pattern.replace('\\', '/').lower()
+        # a pattern without an extension of its own, e.g. "*0002*", only picks mdr entries
+        any_type = os.path.splitext(os.path.basename(pattern))[1] not in ("", ".mdr")
+        with BrzFile(args.brz, stats=stats) as brz:
+            for i in range(0, len(brz.table)):
+                key = brz.table.key(i)
+                if not any_type and not key.endswith(".mdr"):
+                    continue
+                if not fnmatch.fnmatchcase(key, pattern) and not fnmatch.fnmatchcase(os.path.basename(key), pattern):
+                    continue
+                print("# ", key)
+                data = brz.read_entry(key)
+                m = None
+                try:
+                    base_name = os.path.splitext(brz.table.names[i])[0]
+                    m = MDR(key, base_name, args.parse_only, args.parse_only, args.verbose, trace)
+                    read(m, data)
+                    dump(m)
+                finally:
+                    m = None
+                    try:
+                        data.release()
+                    except BufferError:
+                        pass  # arrays of a lazily read model still use it, the map is freed with them
+        stats.finish()
+        sys.exit()
+
+    if len(args.file) > 1 or len(args.file) == 1 and (os.path.isdir(args.file[0]) or args.file[0].lower().endswith(".brz")):
+        if args.summary:
+            parser.error("--summary only works with a single mdr file or -b")
+        t0 = time.time()
+        with stats.stage("batch") as stage:
+            tasks = batch_tasks(args.file, args.outdir)
+            collisions = output_collisions(tasks)
+            if collisions:
+                for key, names in sorted(collisions.items()):
+                    print("Error, %s would be written by %s" % (key, ", ".join(names)))
+                print("Convert these inputs with separate -o directories")
+                sys.exit(1)
+            results = convert_batch(tasks, args.jobs, args.parse_only, cache, print_progress,
+                                    (args.format, args.merge))
+            stage.add(sum(r["bytes_read"] for r in results), sum(r["bytes_written"] for r in results))
+        print("")
+        print_batch_summary(results, time.time() - t0)
+        stats.finish()
+        sys.exit(1 if any(not r["ok"] for r in results) else 0)
 
     filepath = None
-    if args.file is None:
+    if len(args.file) == 0:
         print("Error, supply a file as parameter")
         sys.exit()
     else:
-        filepath = args.file
+        filepath = args.file[0]
     
     print("# ", filepath)
     base_name = os.path.splitext(os.path.basename(filepath))[0]
-    m = MDR(filepath, base_name, args.parse_only, args.parse_only, args.verbose)
-    m.read(args.outdir)
-
-    if not args.parse_only:
-        for ob in m.objects:
-            with open(os.path.join(args.outdir, "%s_%s.obj" % (ob.base_name, ob.name)), 'wb') as obj_fout:
-                obj_fout.write(make_wavefront_obj(ob).encode("ascii"))
-            with open(os.path.join(args.outdir, "%s_%s.mtl" % (ob.base_name, ob.name)), 'wb') as mtl_fout:
-                mtl_fout.write(make_wavefront_mtl(ob).encode("ascii"))
+    m = MDR(filepath, base_name, args.parse_only, args.parse_only, args.verbose, trace)
+    read(m)
+    dump(m)
+    stats.finish()